@@ -0,0 +1,503 @@
+"""In-process stand-ins for the backends used by main.py.
+
+FakeDatastoreClient and FakeStorageClient implement the subset of the
+google-cloud-datastore / google-cloud-storage client APIs that the app uses,
+keep everything in memory, and can inject a fixed latency per RPC.
+Every RPC is counted under the label held in CURRENT_LABEL, so a driver can
+attribute backend calls to the route it is exercising.
+
+FakeRedis implements the few redis-py commands used by caches.RedisCache,
+standing in for a shared cache, and runs ratelimit.TAKE_TOKEN_SCRIPT (through
+a Python port of it) for ratelimit.RedisBucketStore.
+
+LocalJWKS serves a JWKS document from 127.0.0.1 (optionally after a delay) and
+issues RS256 tokens signed with the matching key, standing in for Auth0.
+"""
+import base64
+import contextvars
+import copy
+import datetime
+import hashlib
+import itertools
+import json
+import math
+import threading
+import time
+from collections import Counter, defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import jwt
+from cryptography.hazmat.primitives.asymmetric import rsa
+from google.api_core.exceptions import BadRequest, NotFound
+from google.cloud import datastore as gcloud_datastore
+from jwt.algorithms import RSAAlgorithm
+
+import ratelimit
+
+
+CURRENT_LABEL = contextvars.ContextVar("benchmark_label", default=None)
+
+# Datastore rejects a commit with more mutations than this
+MAX_COMMIT_MUTATIONS = 500
+
+
+class _RpcCounter:
+    def __init__(self, latency):
+        self.latency = latency
+        self.rpc_counts = Counter()
+        self._counter_lock = threading.Lock()
+
+    def _rpc(self, name):
+        with self._counter_lock:
+            self.rpc_counts[(CURRENT_LABEL.get(), name)] += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def calls_by_label(self):
+        totals = Counter()
+        for (label, _), count in self.rpc_counts.items():
+            totals[label] += count
+        return totals
+
+
+# ---------------------------------------------------------------------------
+# Datastore
+# ---------------------------------------------------------------------------
+
+class FakeDatastoreClient(_RpcCounter):
+    def __init__(self, project="benchmark", latency=0.0):
+        super().__init__(latency)
+        self.project = project
+        self._entities = {}
+        self._by_kind = defaultdict(dict)
+        self._by_parent = defaultdict(dict)
+        self._lock = threading.RLock()
+        self._ids = itertools.count(5000000000)
+        self._local = threading.local()
+
+    @property
+    def current_transaction(self):
+        return getattr(self._local, "transaction", None)
+
+    current_batch = current_transaction
+
+    def key(self, *path_args, **kwargs):
+        kwargs.setdefault("project", self.project)
+        return gcloud_datastore.Key(*path_args, **kwargs)
+
+    def _copy(self, entity):
+        clone = gcloud_datastore.Entity(key=entity.key, exclude_from_indexes=tuple(entity.exclude_from_indexes))
+        clone.update(copy.deepcopy(dict(entity)))
+        return clone
+
+    def get(self, key, **kwargs):
+        found = self.get_multi([key])
+        return found[0] if found else None
+
+    def get_multi(self, keys, **kwargs):
+        self._rpc("lookup")
+        with self._lock:
+            return [self._copy(self._entities[key.flat_path]) for key in keys if key.flat_path in self._entities]
+
+    def put(self, entity, **kwargs):
+        self.put_multi([entity])
+
+    def put_multi(self, entities, **kwargs):
+        mutations = [("put", entity) for entity in entities]
+        if self.current_transaction is not None:
+            self.current_transaction.mutations.extend(mutations)
+            return
+        self._commit(mutations)
+
+    def delete(self, key, **kwargs):
+        self.delete_multi([key])
+
+    def delete_multi(self, keys, **kwargs):
+        mutations = [("delete", key.key if isinstance(key, gcloud_datastore.Entity) else key) for key in keys]
+        if self.current_transaction is not None:
+            self.current_transaction.mutations.extend(mutations)
+            return
+        self._commit(mutations)
+
+    def _commit(self, mutations):
+        self._rpc("commit")
+        if len(mutations) > MAX_COMMIT_MUTATIONS:
+            raise BadRequest("cannot write more than 500 entities in a single call")
+        self._apply(mutations)
+
+    def _apply(self, mutations):
+        with self._lock:
+            for op, item in mutations:
+                if op == "put":
+                    if item.key.is_partial:
+                        item.key = item.key.completed_key(next(self._ids))
+                    key, stored = item.key, self._copy(item)
+                else:
+                    key, stored = item, None
+                indexes = [self._entities, self._by_kind[key.kind]]
+                if key.parent is not None:
+                    indexes.append(self._by_parent[(key.parent.flat_path, key.kind)])
+                for index in indexes:
+                    if stored is None:
+                        index.pop(key.flat_path, None)
+                    else:
+                        index[key.flat_path] = stored
+
+    def transaction(self, **kwargs):
+        return FakeTransaction(self)
+
+    def batch(self):
+        return FakeTransaction(self)
+
+    def query(self, kind=None, ancestor=None, projection=(), order=(), filters=(), **kwargs):
+        query = FakeQuery(self, kind, ancestor)
+        query.projection = list(projection)
+        query.order = list(order)
+        for flt in filters:
+            query.add_filter(*flt)
+        return query
+
+    # Ancestor queries only see direct children, which is all the app's schema uses
+    def _scan(self, query):
+        with self._lock:
+            if query.ancestor is not None:
+                entities = list(self._by_parent[(query.ancestor.flat_path, query.kind)].values())
+            elif query.kind:
+                entities = list(self._by_kind[query.kind].values())
+            else:
+                entities = list(self._entities.values())
+        results = []
+        for entity in entities:
+            if all(_matches(entity, flt) for flt in query.filters):
+                results.append(entity)
+        for prop in reversed(query.order or ["__key__"]):
+            name = prop.lstrip("-")
+            results.sort(key=lambda entity: _sort_value(entity, name), reverse=prop.startswith("-"))
+        return results
+
+
+def _matches(entity, flt):
+    name, op, value = flt
+    if name == "__key__":
+        actual = [entity.key]
+    elif name not in entity:
+        return False
+    else:
+        actual = entity[name] if isinstance(entity[name], list) else [entity[name]]
+    if op == "=":
+        return value in actual
+    if op == "IN":
+        return any(v in actual for v in value)
+    raise NotImplementedError(f"FakeQuery does not support operator {op!r}")
+
+
+def _sort_value(entity, name):
+    if name == "__key__":
+        return entity.key.flat_path
+    value = entity.get(name)
+    return (value is not None, value)
+
+
+# Buffers writes and applies them atomically on a clean exit, like a Datastore transaction
+class FakeTransaction:
+    def __init__(self, client):
+        self.client = client
+        self.mutations = []
+
+    def __enter__(self):
+        self.client._local.transaction = self
+        return self
+
+    def put(self, entity):
+        self.mutations.append(("put", entity))
+
+    def delete(self, key):
+        self.mutations.append(("delete", key))
+
+    def __exit__(self, exc_type, exc, tb):
+        self.client._local.transaction = None
+        if exc_type is None:
+            self.client._commit(self.mutations)
+        return False
+
+
+class FakeQuery:
+    def __init__(self, client, kind, ancestor):
+        self._client = client
+        self.kind = kind
+        self.ancestor = ancestor
+        self.filters = []
+        self.projection = []
+        self.order = []
+
+    def add_filter(self, property_name=None, operator=None, value=None, *, filter=None):
+        if filter is not None:
+            property_name, operator, value = filter.property_name, filter.operator, filter.value
+        self.filters.append((property_name, operator, value))
+        return self
+
+    def keys_only(self):
+        self.projection = ["__key__"]
+
+    def fetch(self, limit=None, offset=None, start_cursor=None, **kwargs):
+        return FakeIterator(self, limit, offset, start_cursor)
+
+
+# Cursors are the base64-encoded position in the (sorted) result set
+class FakeIterator:
+    def __init__(self, query, limit, offset, start_cursor):
+        self._query = query
+        self._limit = limit
+        self._offset = offset or 0
+        if start_cursor:
+            if isinstance(start_cursor, str):
+                start_cursor = start_cursor.encode()
+            self._offset = int(base64.urlsafe_b64decode(start_cursor))
+        self.next_page_token = None
+        self._results = None
+
+    def _load(self):
+        if self._results is not None:
+            return self._results
+        client = self._query._client
+        client._rpc("run_query")
+        matched = client._scan(self._query)
+        stop = len(matched) if self._limit is None else self._offset + self._limit
+        page = matched[self._offset:stop]
+        if self._limit is not None and stop < len(matched):
+            self.next_page_token = base64.urlsafe_b64encode(str(stop).encode())
+        projection = self._query.projection
+        self._results = []
+        for entity in page:
+            clone = gcloud_datastore.Entity(key=entity.key)
+            if projection and projection != ["__key__"]:
+                clone.update({name: copy.deepcopy(entity.get(name)) for name in projection})
+            elif not projection:
+                clone.update(copy.deepcopy(dict(entity)))
+            self._results.append(clone)
+        return self._results
+
+    @property
+    def pages(self):
+        yield iter(self._load())
+
+    def __iter__(self):
+        return iter(self._load())
+
+
+# ---------------------------------------------------------------------------
+# Cloud Storage
+# ---------------------------------------------------------------------------
+
+class FakeStorageClient(_RpcCounter):
+    def __init__(self, latency=0.0):
+        super().__init__(latency)
+        self._buckets = {}
+        self._lock = threading.Lock()
+
+    def bucket(self, name):
+        with self._lock:
+            if name not in self._buckets:
+                self._buckets[name] = FakeBucket(self, name)
+            return self._buckets[name]
+
+    def get_bucket(self, name):
+        self._rpc("bucket_get")
+        return self.bucket(name)
+
+
+class FakeBucket:
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+        self._objects = {}
+        self._generations = itertools.count(1700000000000000)
+
+    def blob(self, name):
+        return FakeBlob(self, name)
+
+    def get_blob(self, name, **kwargs):
+        self.client._rpc("object_get")
+        if name not in self._objects:
+            return None
+        blob = FakeBlob(self, name)
+        blob._load_metadata()
+        return blob
+
+    def list_blobs(self, prefix=None, **kwargs):
+        self.client._rpc("object_list")
+        for name in sorted(self._objects):
+            if prefix is None or name.startswith(prefix):
+                blob = FakeBlob(self, name)
+                blob._load_metadata()
+                yield blob
+
+
+class FakeBlob:
+    def __init__(self, bucket, name):
+        self.bucket = bucket
+        self.name = name
+        self.generation = None
+        self.etag = None
+        self.updated = None
+        self.size = None
+        self.content_type = None
+        self.chunk_size = None
+
+    def _load_metadata(self):
+        data, generation, content_type, updated = self.bucket._objects[self.name]
+        self.generation = generation
+        self.etag = hashlib.md5(data).hexdigest()
+        self.size = len(data)
+        self.content_type = content_type
+        self.updated = updated
+
+    def exists(self, **kwargs):
+        self.bucket.client._rpc("object_get")
+        return self.name in self.bucket._objects
+
+    def reload(self, **kwargs):
+        self.bucket.client._rpc("object_get")
+        if self.name not in self.bucket._objects:
+            raise NotFound(self.name)
+        self._load_metadata()
+
+    def upload_from_file(self, file_obj, content_type=None, size=None, **kwargs):
+        if size is not None:
+            data = file_obj.read(size)
+        elif self.chunk_size:
+            # Resumable upload: reads chunk_size pieces until a short one marks the end
+            parts = [file_obj.read(self.chunk_size)]
+            while len(parts[-1]) == self.chunk_size:
+                parts.append(file_obj.read(self.chunk_size))
+            data = b"".join(parts)
+        else:
+            data = file_obj.read()
+        self.upload_from_string(data, content_type=content_type)
+
+    def upload_from_string(self, data, content_type=None, **kwargs):
+        self.bucket.client._rpc("object_insert")
+        if isinstance(data, str):
+            data = data.encode()
+        updated = datetime.datetime.now(datetime.timezone.utc).replace(microsecond=0)
+        self.bucket._objects[self.name] = (bytes(data), next(self.bucket._generations), content_type, updated)
+        self._load_metadata()
+
+    def download_as_bytes(self, start=None, end=None, **kwargs):
+        self.bucket.client._rpc("object_media")
+        if self.name not in self.bucket._objects:
+            raise NotFound(self.name)
+        data = self.bucket._objects[self.name][0]
+        start = start or 0
+        return data[start:] if end is None else data[start:end + 1]
+
+    def download_to_file(self, file_obj, **kwargs):
+        file_obj.write(self.download_as_bytes())
+
+    def delete(self, **kwargs):
+        self.bucket.client._rpc("object_delete")
+        if self.bucket._objects.pop(self.name, None) is None:
+            raise NotFound(self.name)
+
+
+# ---------------------------------------------------------------------------
+# Redis
+# ---------------------------------------------------------------------------
+
+class FakeRedis(_RpcCounter):
+    def __init__(self, latency=0.0):
+        super().__init__(latency)
+        self._data = {}
+        self._lock = threading.Lock()
+
+    def _live(self, key, now):
+        item = self._data.get(key)
+        if item is not None and item[1] is not None and item[1] <= now:
+            del self._data[key]
+            return None
+        return item
+
+    def get(self, key):
+        self._rpc("get")
+        with self._lock:
+            item = self._live(key, time.monotonic())
+            return item[0].encode() if item is not None else None
+
+    def set(self, key, value, ex=None, px=None, nx=False):
+        self._rpc("set")
+        now = time.monotonic()
+        expires_at = now + ex if ex is not None else now + px / 1000 if px is not None else None
+        with self._lock:
+            if nx and self._live(key, now) is not None:
+                return None
+            self._data[key] = (value.decode() if isinstance(value, bytes) else str(value), expires_at)
+            return True
+
+    def delete(self, *keys):
+        self._rpc("delete")
+        with self._lock:
+            return sum(1 for key in keys if self._data.pop(key, None) is not None)
+
+    # Only the scripts the app sends are known, each run atomically like on a real server
+    def eval(self, script, numkeys, *keys_and_args):
+        self._rpc("eval")
+        if script != ratelimit.TAKE_TOKEN_SCRIPT:
+            raise NotImplementedError("FakeRedis can't run this script")
+        (key,), (interval, burst) = keys_and_args[:numkeys], keys_and_args[numkeys:]
+        now_ms = time.time() * 1000
+        with self._lock:
+            item = self._live(key, time.monotonic())
+            tat, wait = ratelimit.take_token(float(item[0]) if item else None, now_ms, interval, burst)
+            if tat is None:
+                return math.ceil(wait)
+            self._data[key] = (f"{tat:.3f}", time.monotonic() + (tat - now_ms) / 1000)
+            return 0
+
+
+# ---------------------------------------------------------------------------
+# Auth0
+# ---------------------------------------------------------------------------
+
+class LocalJWKS:
+    def __init__(self, audience, issuer="https://tarpaulin.local/", kid="benchmark-key", latency=0.0):
+        self.audience = audience
+        self.issuer = issuer
+        self.kid = kid
+        self.latency = latency
+        self.fetches = 0
+        self._private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        jwk = json.loads(RSAAlgorithm.to_jwk(self._private_key.public_key()))
+        jwk.update({"kid": kid, "use": "sig", "alg": "RS256"})
+        self._document = json.dumps({"keys": [jwk]}).encode()
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self._server.server_port}/.well-known/jwks.json"
+
+    def _handler(self):
+        jwks = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                jwks.fetches += 1
+                if jwks.latency:
+                    time.sleep(jwks.latency)
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(jwks._document)))
+                self.end_headers()
+                self.wfile.write(jwks._document)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
+
+    def issue(self, sub, ttl=3600):
+        claims = {"sub": sub, "aud": self.audience, "iss": self.issuer, "exp": int(time.time()) + ttl}
+        return jwt.encode(claims, self._private_key, algorithm="RS256", headers={"kid": self.kid})
+
+    def close(self):
+        self._server.shutdown()
@@ -0,0 +1,347 @@
+"""Load test for the Tarpaulin API against in-process Datastore/GCS/Auth0 stand-ins.
+
+Drives the Flask app from main.py with a weighted mix of realistic requests at a
+fixed concurrency and reports, per route, throughput, p50/p95/p99 latency and the
+average number of backend RPCs each request made.
+
+    python -m benchmarks.load_test --requests 5000 --concurrency 16 \\
+        --datastore-latency-ms 4 --gcs-latency-ms 15
+
+Pass --backend sqlite to run the same mix against the embedded SQLite
+repository (in a temporary database file) instead of the Datastore stand-in, and
+--course-cache shared|off to put the course cache on a Redis stand-in or disable it.
+Rate limiting is off by default; --rate-limit local|shared turns it on with
+budgets the run can't exhaust, to measure what admission control costs per request.
+
+Save a run with --json and compare later runs against it with --baseline; the
+command exits non-zero when a route's p99 or RPCs per request regress by more
+than --tolerance.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+from benchmarks.fakes import CURRENT_LABEL, FakeDatastoreClient, FakeRedis, FakeStorageClient, LocalJWKS
+
+
+AUDIENCE = "https://tarpaulin.benchmark/api"
+PNG_HEADER = b"\x89PNG\r\n\x1a\n"
+
+DEFAULT_MIX = {
+    "get_all_courses": 25,
+    "get_avatar": 25,
+    "get_course_enrollment": 15,
+    "get_user": 15,
+    "get_course": 10,
+    "update_enrollment": 10,
+}
+
+
+# Import main.py wired to the given fakes instead of real Google clients
+def load_app(datastore_client, storage_client, jwks, backend="datastore", sqlite_path=None,
+             course_cache="local", redis_client=None, rate_limit="off"):
+    os.environ["AUTH0_AUDIENCE"] = jwks.audience
+    os.environ["AUTH0_ISSUER"] = jwks.issuer
+    os.environ["AUTH0_JWKS_URL"] = jwks.url
+    os.environ["TARPAULIN_BACKEND"] = backend
+    if sqlite_path:
+        os.environ["SQLITE_PATH"] = sqlite_path
+    if course_cache == "off":
+        os.environ["COURSE_CACHE_SIZE"] = "0"
+    with mock.patch("google.cloud.datastore.Client", return_value=datastore_client):
+        import main
+    if backend == "datastore":
+        main.repo = main.repository.DatastoreRepository(main.metrics.instrument_datastore(datastore_client))
+    if course_cache == "shared":
+        main.course_cache = main.RedisCache(redis_client, ttl=main.COURSE_CACHE_TTL)
+    if rate_limit == "off":
+        main.rate_limiter = None
+    else:
+        store = (main.ratelimit.RedisBucketStore(redis_client) if rate_limit == "shared"
+                 else main.ratelimit.LocalBucketStore())
+        unlimited = main.ratelimit.Limit(rate=1e6, burst=1e6)
+        main.rate_limiter = main.ratelimit.RateLimiter(store, unlimited, unlimited, main.EXPENSIVE_ENDPOINTS)
+    main._storage_client = storage_client
+    main._photo_bucket = None
+    return main
+
+
+# Seeds users, courses, enrollments and avatars through the app's repository
+class Dataset:
+    def __init__(self, main, args, rng):
+        repo = main.repo
+
+        def put_user(role, sub, **extra):
+            return repo.create_user({"role": role, "sub": sub, **extra}).id
+
+        self.admin_sub = "auth0|benchmark-admin"
+        put_user("admin", self.admin_sub)
+
+        self.instructors = {}
+        for i in range(args.instructors):
+            sub = f"auth0|benchmark-instructor-{i}"
+            self.instructors[put_user("instructor", sub, courses=[])] = sub
+
+        self.students = {}
+        for i in range(args.students):
+            sub = f"auth0|benchmark-student-{i}"
+            self.students[put_user("student", sub, courses=[])] = sub
+
+        # Courses, each with a random class of students
+        self.courses = {}
+        instructor_ids = list(self.instructors)
+        student_ids = list(self.students)
+        subjects = ["ART", "BIO", "CHEM", "CS", "ECE", "HIST", "MATH", "PHYS"]
+        for i in range(args.courses):
+            course = repo.create_course({
+                "subject": rng.choice(subjects),
+                "number": 100 + i,
+                "title": f"Benchmark course {i}",
+                "term": "fall-24",
+                "instructor_id": rng.choice(instructor_ids)
+            })
+            self.courses[course.id] = course["instructor_id"]
+
+            roster = rng.sample(student_ids, min(args.class_size, len(student_ids)))
+            repo.update_enrollment(course.id, roster, [])
+
+        # Avatars for a share of the students
+        bucket = main.get_photo_bucket()
+        self.avatar_owners = rng.sample(student_ids, int(len(student_ids) * args.avatar_share))
+        payload = PNG_HEADER + os.urandom(args.avatar_bytes)
+        thumbnail = PNG_HEADER + os.urandom(args.avatar_bytes // 50)
+        for owner in repo.get_users(self.avatar_owners):
+            blob = bucket.blob(main.avatar_blob_name(owner.id))
+            blob.upload_from_string(payload, content_type="image/png")
+            bucket.blob(main.avatar_blob_name(owner.id, 48)).upload_from_string(thumbnail, content_type="image/png")
+            owner["has_avatar"] = True
+            owner["avatar_generation"] = blob.generation
+            owner["avatar_variants"] = [48]
+            repo.save_user(owner)
+
+
+class Scenarios:
+    def __init__(self, data, jwks, rng):
+        self.data = data
+        self.rng = rng
+        self._tokens = {}
+        self._jwks = jwks
+        self._next_links = []
+        self._lock = threading.Lock()
+
+    def auth(self, sub):
+        if sub not in self._tokens:
+            self._tokens[sub] = self._jwks.issue(sub)
+        return {"Authorization": f"Bearer {self._tokens[sub]}"}
+
+    def get_all_courses(self, client):
+        with self._lock:
+            link = self._next_links.pop() if self._next_links and self.rng.random() < 0.5 else None
+        response = client.get(link or "/courses?limit=10")
+        next_link = response.get_json().get("next") if response.status_code == 200 else None
+        if next_link:
+            with self._lock:
+                self._next_links.append(next_link.replace("http://localhost", ""))
+                del self._next_links[:-100]
+        return response
+
+    def get_course(self, client):
+        return client.get(f"/courses/{self.rng.choice(list(self.data.courses))}")
+
+    def get_avatar(self, client):
+        student_id = self.rng.choice(self.data.avatar_owners)
+        return client.get(f"/users/{student_id}/avatar", headers=self.auth(self.data.students[student_id]))
+
+    def get_avatar_thumbnail(self, client):
+        student_id = self.rng.choice(self.data.avatar_owners)
+        return client.get(f"/users/{student_id}/avatar?size=48", headers=self.auth(self.data.students[student_id]))
+
+    def get_user(self, client):
+        student_id = self.rng.choice(list(self.data.students))
+        return client.get(f"/users/{student_id}", headers=self.auth(self.data.students[student_id]))
+
+    def get_course_enrollment(self, client):
+        course_id, instructor_id = self.rng.choice(list(self.data.courses.items()))
+        return client.get(f"/courses/{course_id}/students", headers=self.auth(self.data.instructors[instructor_id]))
+
+    def update_enrollment(self, client):
+        course_id = self.rng.choice(list(self.data.courses))
+        picked = self.rng.sample(list(self.data.students), 4)
+        body = {"add": picked[:2], "remove": picked[2:]}
+        return client.patch(f"/courses/{course_id}/students", json=body, headers=self.auth(self.data.admin_sub))
+
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return 0.0
+    index = max(0, min(len(sorted_values) - 1, int(round(pct / 100 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[index]
+
+
+def run(args):
+    rng = random.Random(args.seed)
+    datastore_client = FakeDatastoreClient()
+    storage_client = FakeStorageClient()
+    jwks = LocalJWKS(AUDIENCE)
+    sqlite_dir = tempfile.TemporaryDirectory() if args.backend == "sqlite" else None
+    sqlite_path = os.path.join(sqlite_dir.name, "benchmark.db") if sqlite_dir else None
+    redis_client = FakeRedis()
+    main = load_app(datastore_client, storage_client, jwks, backend=args.backend, sqlite_path=sqlite_path,
+                    course_cache=args.course_cache, redis_client=redis_client, rate_limit=args.rate_limit)
+
+    data = Dataset(main, args, rng)
+    scenarios = Scenarios(data, jwks, rng)
+    mix = parse_mix(args.mix)
+    names = list(mix)
+    weights = [mix[name] for name in names]
+    plan = rng.choices(names, weights=weights, k=args.requests)
+
+    # Inject latency only once the dataset is seeded
+    datastore_client.latency = args.datastore_latency_ms / 1000
+    storage_client.latency = args.gcs_latency_ms / 1000
+    redis_client.latency = args.cache_latency_ms / 1000
+    datastore_client.rpc_counts.clear()
+    storage_client.rpc_counts.clear()
+
+    latencies = defaultdict(list)
+    errors = defaultdict(int)
+    local = threading.local()
+
+    def one(name):
+        if not hasattr(local, "client"):
+            local.client = main.app.test_client()
+        token = CURRENT_LABEL.set(name)
+        try:
+            started = time.perf_counter()
+            response = getattr(scenarios, name)(local.client)
+            elapsed = time.perf_counter() - started
+        finally:
+            CURRENT_LABEL.reset(token)
+        latencies[name].append(elapsed)
+        if response.status_code >= 400:
+            errors[name] += 1
+
+    # Warm the JWKS/token caches so they don't skew the first samples
+    for sub in [data.admin_sub] + list(data.instructors.values()):
+        scenarios.auth(sub)
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        list(pool.map(one, plan))
+    wall = time.perf_counter() - started
+
+    ds_calls = datastore_client.calls_by_label()
+    gcs_calls = storage_client.calls_by_label()
+    routes = {}
+    for name in sorted(latencies):
+        samples = sorted(latencies[name])
+        count = len(samples)
+        routes[name] = {
+            "requests": count,
+            "errors": errors[name],
+            "throughput_rps": count / wall,
+            "p50_ms": percentile(samples, 50) * 1000,
+            "p95_ms": percentile(samples, 95) * 1000,
+            "p99_ms": percentile(samples, 99) * 1000,
+            "datastore_rpcs_per_request": ds_calls[name] / count,
+            "gcs_rpcs_per_request": gcs_calls[name] / count,
+        }
+    jwks.close()
+    if sqlite_dir:
+        sqlite_dir.cleanup()
+    return {
+        "config": vars(args),
+        "wall_seconds": wall,
+        "throughput_rps": args.requests / wall,
+        "routes": routes,
+    }
+
+
+def parse_mix(spec):
+    if not spec:
+        return dict(DEFAULT_MIX)
+    mix = {}
+    for part in spec.split(","):
+        name, _, weight = part.partition("=")
+        if not hasattr(Scenarios, name.strip()):
+            raise SystemExit(f"Unknown scenario in --mix: {name}")
+        mix[name.strip()] = float(weight or 1)
+    return mix
+
+
+def print_report(report):
+    print(f"{report['config']['requests']} requests at concurrency {report['config']['concurrency']} "
+          f"on {report['config']['backend']}: "
+          f"{report['throughput_rps']:.1f} req/s over {report['wall_seconds']:.2f}s")
+    header = f"{'route':<24}{'n':>7}{'err':>6}{'rps':>9}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'ds/req':>8}{'gcs/req':>9}"
+    print(header)
+    print("-" * len(header))
+    for name, row in report["routes"].items():
+        print(f"{name:<24}{row['requests']:>7}{row['errors']:>6}{row['throughput_rps']:>9.1f}"
+              f"{row['p50_ms']:>9.2f}{row['p95_ms']:>9.2f}{row['p99_ms']:>9.2f}"
+              f"{row['datastore_rpcs_per_request']:>8.2f}{row['gcs_rpcs_per_request']:>9.2f}")
+
+
+# Returns the list of regressions of `report` relative to `baseline`
+def compare(report, baseline, tolerance):
+    regressions = []
+    for name, row in report["routes"].items():
+        base = baseline.get("routes", {}).get(name)
+        if not base:
+            continue
+        for metric in ("p99_ms", "datastore_rpcs_per_request", "gcs_rpcs_per_request"):
+            if row[metric] > base[metric] * (1 + tolerance) + 1e-9:
+                regressions.append(f"{name} {metric}: {base[metric]:.2f} -> {row[metric]:.2f}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--backend", choices=["datastore", "sqlite"], default="datastore")
+    parser.add_argument("--course-cache", choices=["local", "shared", "off"], default="local")
+    parser.add_argument("--rate-limit", choices=["off", "local", "shared"], default="off")
+    parser.add_argument("--requests", type=int, default=2000)
+    parser.add_argument("--concurrency", type=int, default=8)
+    parser.add_argument("--datastore-latency-ms", type=float, default=0.0)
+    parser.add_argument("--gcs-latency-ms", type=float, default=0.0)
+    parser.add_argument("--cache-latency-ms", type=float, default=0.0, help="per command, with --course-cache/--rate-limit shared")
+    parser.add_argument("--mix", help="weighted scenarios, e.g. get_avatar=30,update_enrollment=5")
+    parser.add_argument("--students", type=int, default=2000)
+    parser.add_argument("--instructors", type=int, default=40)
+    parser.add_argument("--courses", type=int, default=200)
+    parser.add_argument("--class-size", type=int, default=30)
+    parser.add_argument("--avatar-share", type=float, default=0.5)
+    parser.add_argument("--avatar-bytes", type=int, default=20 * 1024)
+    parser.add_argument("--seed", type=int, default=493)
+    parser.add_argument("--json", help="write the report to this file")
+    parser.add_argument("--baseline", help="compare against a report written earlier with --json")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args(argv)
+
+    report = run(args)
+    print_report(report)
+
+    if args.json:
+        with open(args.json, "w") as fh:
+            json.dump(report, fh, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as fh:
+            regressions = compare(report, json.load(fh), args.tolerance)
+        for line in regressions:
+            print("REGRESSION", line)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,222 @@
+"""Startup benchmark for the Tarpaulin API: import time and first-request latency.
+
+Each run starts a fresh Python process, so the measurements are for a new
+instance. The process times `import main`, then wires the app to the in-process
+stand-ins from benchmarks/fakes.py and times the first and second request to a
+few routes:
+
+- get_all_courses reads from the repository.
+- get_user also verifies a token, which needs the Auth0 signing keys.
+- get_avatar also reads from Cloud Storage.
+
+Creating a backend client is simulated by sleeping --client-init-ms, in place of
+the credential and project lookups. Fetching the signing keys takes
+--jwks-latency-ms. Runs alternate between "cold", where the requests arrive
+first, and "warmup", where App Engine's GET /_ah/warmup comes before them. The
+report shows the median of --runs runs per mode:
+
+    python -m benchmarks.startup --runs 5 --json startup.json
+    python -m benchmarks.startup --runs 5 --baseline startup.json
+
+With --baseline, the command exits non-zero if any timing grew by more than
+--tolerance (default 20%) plus --slack-ms, which absorbs timer noise on
+sub-millisecond steps. Library imports are counted in the import time only:
+setting up the stand-ins loads the Cloud Storage library before the first
+request.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+
+AUDIENCE = "https://tarpaulin.benchmark/api"
+ISSUER = "https://tarpaulin.local/"
+PNG_HEADER = b"\x89PNG\r\n\x1a\n"
+MODES = ("cold", "warmup")
+ROUTES = ("get_all_courses", "get_user", "get_avatar")
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+# Runs in the child process: measures one startup and returns its timings
+def measure(args):
+    os.environ["AUTH0_AUDIENCE"] = AUDIENCE
+    os.environ["AUTH0_ISSUER"] = ISSUER
+    os.environ["TARPAULIN_BACKEND"] = args.backend
+    sqlite_dir = tempfile.TemporaryDirectory() if args.backend == "sqlite" else None
+    if sqlite_dir:
+        os.environ["SQLITE_PATH"] = os.path.join(sqlite_dir.name, "startup.db")
+
+    started = time.perf_counter()
+    import main
+    import_ms = (time.perf_counter() - started) * 1000
+
+    # Only now load the stand-ins, so their imports aren't counted against main
+    from unittest import mock
+
+    import google.auth
+    from google.auth.credentials import AnonymousCredentials
+
+    from benchmarks.fakes import FakeDatastoreClient, FakeStorageClient, LocalJWKS
+
+    client_init = args.client_init_ms / 1000
+    datastore_client = FakeDatastoreClient()
+    storage_client = FakeStorageClient()
+    jwks = LocalJWKS(AUDIENCE, issuer=ISSUER, latency=args.jwks_latency_ms / 1000)
+    main.AUTH0_JWKS_URL = jwks.url
+
+    # Seed through a repository of our own, leaving the app's still uncreated
+    if args.backend == "sqlite":
+        seed_repo = main.repository.SQLiteRepository(main.SQLITE_PATH)
+    else:
+        seed_repo = main.repository.DatastoreRepository(datastore_client)
+    admin = seed_repo.create_user({"role": "admin", "sub": "auth0|startup-admin"})
+    student = seed_repo.create_user({"role": "student", "sub": "auth0|startup-student", "courses": []})
+    seed_repo.create_course({"subject": "CS", "number": 493, "title": "Cloud Application Development",
+                             "term": "fall-24", "instructor_id": admin.id})
+    blob = storage_client.bucket(main.PHOTO_BUCKET).blob(main.avatar_blob_name(student.id))
+    blob.upload_from_string(PNG_HEADER + os.urandom(args.avatar_bytes), content_type="image/png")
+    student["has_avatar"] = True
+    student["avatar_generation"] = blob.generation
+    seed_repo.save_user(student)
+    datastore_client.latency = args.datastore_latency_ms / 1000
+    storage_client.latency = args.gcs_latency_ms / 1000
+
+    def new_datastore_client(*a, **kwargs):
+        time.sleep(client_init)
+        return datastore_client
+
+    def default_credentials(*a, **kwargs):
+        time.sleep(client_init)
+        return AnonymousCredentials(), "benchmark"
+
+    # Each route with the caller allowed to use it
+    requests = {
+        "get_all_courses": ("/courses", admin),
+        "get_user": (f"/users/{admin.id}", admin),
+        "get_avatar": (f"/users/{student.id}/avatar", student),
+    }
+    tokens = {user.id: jwks.issue(user["sub"]) for user in (admin, student)}
+    result = {"import_ms": import_ms, "warmup_ms": None, "first_ms": {}, "second_ms": {}}
+    with mock.patch.object(main.gcloud_datastore, "Client", new_datastore_client), \
+            mock.patch.object(google.auth, "default", default_credentials), \
+            mock.patch("google.cloud.storage.Client", return_value=storage_client):
+        client = main.app.test_client()
+        if args.mode == "warmup":
+            started = time.perf_counter()
+            response = client.get("/_ah/warmup")
+            result["warmup_ms"] = (time.perf_counter() - started) * 1000
+            assert response.status_code == 200, response.status_code
+        for key in ("first_ms", "second_ms"):
+            for name in ROUTES:
+                started = time.perf_counter()
+                path, user = requests[name]
+                response = client.get(path, headers={"Authorization": f"Bearer {tokens[user.id]}"})
+                result[key][name] = (time.perf_counter() - started) * 1000
+                assert response.status_code == 200, (name, response.status_code)
+
+    jwks.close()
+    if sqlite_dir:
+        sqlite_dir.cleanup()
+    return result
+
+
+# Runs in the parent: one child process per run and mode, summarized as medians
+def run(args):
+    samples = {mode: [] for mode in MODES}
+    for _ in range(args.runs):
+        for mode in MODES:
+            command = [sys.executable, "-m", "benchmarks.startup", "--child", mode,
+                       "--backend", args.backend,
+                       "--client-init-ms", str(args.client_init_ms),
+                       "--jwks-latency-ms", str(args.jwks_latency_ms),
+                       "--datastore-latency-ms", str(args.datastore_latency_ms),
+                       "--gcs-latency-ms", str(args.gcs_latency_ms),
+                       "--avatar-bytes", str(args.avatar_bytes)]
+            output = subprocess.run(command, cwd=REPO_ROOT, check=True, capture_output=True, text=True).stdout
+            samples[mode].append(json.loads(output.strip().splitlines()[-1]))
+
+    modes = {}
+    for mode, results in samples.items():
+        timings = {"import_ms": statistics.median(r["import_ms"] for r in results)}
+        if mode == "warmup":
+            timings["warmup_ms"] = statistics.median(r["warmup_ms"] for r in results)
+        for key in ("first_ms", "second_ms"):
+            for name in ROUTES:
+                timings[f"{key[:-3]}:{name}_ms"] = statistics.median(r[key][name] for r in results)
+        modes[mode] = timings
+    config = {key: value for key, value in vars(args).items() if key not in ("mode", "json", "baseline")}
+    return {"config": config, "modes": modes}
+
+
+def print_report(report):
+    config = report["config"]
+    print(f"{config['runs']} runs per mode on {config['backend']}, client init {config['client_init_ms']:g} ms, "
+          f"JWKS fetch {config['jwks_latency_ms']:g} ms (medians)")
+    header = f"{'timing':<28}" + "".join(f"{mode:>10}" for mode in MODES)
+    print(header)
+    print("-" * len(header))
+    names = list(report["modes"]["warmup"])
+    for name in names:
+        cells = []
+        for mode in MODES:
+            value = report["modes"][mode].get(name)
+            cells.append(f"{value:>10.1f}" if value is not None else f"{'-':>10}")
+        print(f"{name:<28}" + "".join(cells))
+
+
+# Returns the list of regressions of `report` relative to `baseline`
+def compare(report, baseline, tolerance, slack_ms):
+    regressions = []
+    for mode, timings in report["modes"].items():
+        base = baseline.get("modes", {}).get(mode, {})
+        for name, value in timings.items():
+            if name in base and value > base[name] * (1 + tolerance) + slack_ms:
+                regressions.append(f"{mode} {name}: {base[name]:.1f} -> {value:.1f}")
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--backend", choices=["datastore", "sqlite"], default="datastore")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--client-init-ms", type=float, default=200.0,
+                        help="simulated cost of creating each backend client")
+    parser.add_argument("--jwks-latency-ms", type=float, default=100.0, help="Auth0 signing key fetch")
+    parser.add_argument("--datastore-latency-ms", type=float, default=4.0)
+    parser.add_argument("--gcs-latency-ms", type=float, default=15.0)
+    parser.add_argument("--avatar-bytes", type=int, default=20 * 1024)
+    parser.add_argument("--json", help="write the report to this file")
+    parser.add_argument("--baseline", help="compare against a report written earlier with --json")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    parser.add_argument("--slack-ms", type=float, default=5.0)
+    parser.add_argument("--child", choices=MODES, dest="mode", help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.mode:
+        print(json.dumps(measure(args)))
+        return 0
+
+    report = run(args)
+    print_report(report)
+
+    if args.json:
+        with open(args.json, "w") as fh:
+            json.dump(report, fh, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as fh:
+            regressions = compare(report, json.load(fh), args.tolerance, args.slack_ms)
+        for line in regressions:
+            print("REGRESSION", line)
+        if regressions:
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
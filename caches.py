@@ -0,0 +1,168 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+# Bounded in-process LRU cache whose entries also expire after a fixed TTL.
+# Safe to share between Flask worker threads.
+class TTLCache:
+    def __init__(self, maxsize=1024, ttl=60.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                return default
+            expires_at, value = item
+            if expires_at <= time.monotonic():
+                del self._data[key]
+                return default
+            self._data.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires_at = time.monotonic() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    # Stores the value only if the key has no live entry; returns whether it did
+    def add(self, key, value, ttl=None):
+        now = time.monotonic()
+        with self._lock:
+            item = self._data.get(key)
+            if item is not None and item[0] > now:
+                return False
+            self._data[key] = (now + (self.ttl if ttl is None else ttl), value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+        return True
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        return len(self._data)
+
+
+# In-process LRU cache bounded by the total size of its values in bytes rather
+# than by entry count. Keeps hit/miss/eviction counters for tuning.
+class ByteLRUCache:
+    def __init__(self, max_bytes, max_item_bytes=None):
+        self.max_bytes = max_bytes
+        self.max_item_bytes = max_bytes if max_item_bytes is None else min(max_item_bytes, max_bytes)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._bytes = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    # Returns False (and caches nothing) when the value is too large to keep
+    def set(self, key, value, size):
+        if size > self.max_item_bytes:
+            return False
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self._bytes -= old[1]
+            self._data[key] = (value, size)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                _, (_, evicted_size) = self._data.popitem(last=False)
+                self._bytes -= evicted_size
+                self.evictions += 1
+        return True
+
+    def delete(self, key):
+        with self._lock:
+            item = self._data.pop(key, None)
+            if item is not None:
+                self._bytes -= item[1]
+
+    def delete_matching(self, predicate):
+        with self._lock:
+            for key in [key for key in self._data if predicate(key)]:
+                self._bytes -= self._data.pop(key)[1]
+
+    def stats(self):
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self._data),
+                "bytes": self._bytes,
+                "max_bytes": self.max_bytes
+            }
+
+
+# String cache kept in a shared Redis, so every instance sees the same entries and
+# invalidations. Has the get/set/add/delete API of TTLCache. Any client object with
+# redis-py's get/set/delete works, e.g. a local stand-in in tests and benchmarks.
+# Redis errors are logged and treated as misses.
+class RedisCache:
+    def __init__(self, client, ttl=60.0, prefix="tarpaulin:"):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    @classmethod
+    def from_url(cls, url, **kwargs):
+        # Optional dependency, only needed when a shared cache is configured
+        import redis
+        return cls(redis.Redis.from_url(url), **kwargs)
+
+    def _ttl_ms(self, ttl):
+        return max(1, int((self.ttl if ttl is None else ttl) * 1000))
+
+    def get(self, key, default=None):
+        try:
+            value = self.client.get(self.prefix + key)
+        except Exception as e:
+            print("Exception:", e)
+            return default
+        if value is None:
+            return default
+        return value.decode() if isinstance(value, bytes) else value
+
+    def set(self, key, value, ttl=None):
+        try:
+            self.client.set(self.prefix + key, value, px=self._ttl_ms(ttl))
+        except Exception as e:
+            print("Exception:", e)
+
+    def add(self, key, value, ttl=None):
+        try:
+            return bool(self.client.set(self.prefix + key, value, px=self._ttl_ms(ttl), nx=True))
+        except Exception as e:
+            print("Exception:", e)
+            return False
+
+    def delete(self, key):
+        try:
+            self.client.delete(self.prefix + key)
+        except Exception as e:
+            print("Exception:", e)
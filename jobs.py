@@ -0,0 +1,54 @@
+"""In-process background job queue.
+
+Jobs are callables run in submission order by a small pool of daemon worker
+threads, started on first use in each process (threads don't survive a fork).
+The queue lives in memory: whatever a job needs to report back, such as progress
+or its outcome, it records itself, e.g. through the repository, so it can be read
+from any instance. Work still queued when an instance shuts down is lost.
+
+join() blocks until every submitted job has finished, for tests and benchmarks.
+"""
+import contextvars
+import os
+import queue
+import threading
+
+
+class JobQueue:
+    def __init__(self, workers=1, name="jobs"):
+        self.workers = workers
+        self.name = name
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def submit(self, job, *args):
+        self._ensure_workers()
+        # Jobs run with a copy of the submitter's context (e.g. the metrics route label)
+        self._queue.put((contextvars.copy_context(), job, args))
+
+    def join(self):
+        self._queue.join()
+
+    def pending(self):
+        return self._queue.unfinished_tasks
+
+    def _ensure_workers(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            for index in range(self.workers):
+                threading.Thread(target=self._run, name=f"{self.name}-{index}", daemon=True).start()
+
+    def _run(self):
+        while True:
+            context, job, args = self._queue.get()
+            try:
+                context.run(job, *args)
+            except Exception as e:
+                print("Exception:", e)
+            finally:
+                self._queue.task_done()
@@ -1,11 +1,31 @@
-from flask import Flask, request, send_file, jsonify
+from flask import Flask, Response, g, request, jsonify
 import requests
-from google.cloud import storage
+from requests.adapters import HTTPAdapter
+import google.auth
 from google.cloud import datastore as gcloud_datastore
-import io
+from google.api_core.exceptions import NotFound
 import jwt
 from dotenv import load_dotenv
 import os
+import calendar
+import contextvars
+import hashlib
+import io
+import jobs
+import json
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
+from caches import ByteLRUCache, RedisCache, TTLCache
+import metrics
+import profiler
+import ratelimit
+import repository
+import uploads
+from repository import MAX_COURSES_PER_COMMIT, MAX_ENROLLMENT_CHANGES_PER_COMMIT, CourseNotFound, InvalidEnrollment, chunked
+from collections import namedtuple
+from PIL import Image
 
 
 load_dotenv()
@@ -14,16 +34,413 @@ AUTH0_CLIENT_ID = os.getenv("AUTH0_CLIENT_ID")
 AUTH0_CLIENT_SECRET = os.getenv("AUTH0_CLIENT_SECRET")
 AUTH0_DOMAIN = os.getenv("AUTH0_DOMAIN")
 AUTH0_AUDIENCE = os.getenv("AUTH0_AUDIENCE")
+AUTH0_ISSUER = os.getenv("AUTH0_ISSUER") or f"https://{AUTH0_DOMAIN}/"
+AUTH0_JWKS_URL = os.getenv("AUTH0_JWKS_URL") or f"https://{AUTH0_DOMAIN}/.well-known/jwks.json"
+
+# Auth0 signing keys are cached for JWKS_CACHE_TTL seconds; a token with an unknown
+# kid triggers a refetch, at most once every JWKS_MIN_REFRESH seconds
+JWKS_CACHE_TTL = int(os.getenv("JWKS_CACHE_TTL", "3600"))
+JWKS_MIN_REFRESH = float(os.getenv("JWKS_MIN_REFRESH", "30"))
+
+# Already-verified tokens are remembered (by hash) until they expire
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", "4096"))
 
 PHOTO_BUCKET='tarpaulin-bucket-brett'
 
+# Keep-alive connections kept open to Cloud Storage; size it to the worker thread count
+STORAGE_POOL_SIZE = int(os.getenv("STORAGE_POOL_SIZE", "32"))
+
+# Hot avatars are kept in memory, bounded by total bytes
+AVATAR_CACHE_BYTES = int(os.getenv("AVATAR_CACHE_BYTES", str(64 * 1024 * 1024)))
+AVATAR_CACHE_MAX_ITEM_BYTES = int(os.getenv("AVATAR_CACHE_MAX_ITEM_BYTES", str(1024 * 1024)))
+
+# When set, GET /metrics requires "Authorization: Bearer <METRICS_TOKEN>"
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+
+# Opt-in sampling profiler: keep stacks of requests slower than PROFILE_SLOW_MS and/or
+# of a random PROFILE_SAMPLE_RATE share of requests (both unset = profiler off)
+PROFILE_SLOW_MS = float(os.getenv("PROFILE_SLOW_MS", "0"))
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_INTERVAL_MS = float(os.getenv("PROFILE_INTERVAL_MS", "5"))
+PROFILE_DIR = os.getenv("PROFILE_DIR", "/tmp/tarpaulin-profiles")
+PROFILE_FORMAT = os.getenv("PROFILE_FORMAT", "folded")
+
+# Worker threads shared by all requests for running independent backend calls in parallel
+IO_POOL_SIZE = int(os.getenv("IO_POOL_SIZE", "16"))
+
+# Largest accepted image upload; enforced while the body streams in. Uploads go to Cloud
+# Storage in UPLOAD_CHUNK_SIZE pieces (a multiple of 256 KiB) as they arrive
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(5 * 1024 * 1024)))
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Downscaled copies of every uploaded avatar (longest side in pixels) for ?size= requests
+AVATAR_VARIANT_SIZES = (48, 128, 512)
+
+# Bytes fetched from Cloud Storage per ranged read when streaming an object
+STREAM_CHUNK_SIZE = 256 * 1024
+
+# Persistence backend: "datastore" (Cloud Datastore) or "sqlite" (embedded database at SQLITE_PATH)
+TARPAULIN_BACKEND = os.getenv("TARPAULIN_BACKEND", "datastore")
+SQLITE_PATH = os.getenv("SQLITE_PATH", "tarpaulin.db")
+
+# Upper bound for the page size of paginated listings, and the page size of GET /courses
+MAX_PAGE_LIMIT = 100
+DEFAULT_COURSE_PAGE_LIMIT = 3
+
+# Course responses may be stored by browsers and the edge cache but must be revalidated
+# (ETag / If-None-Match) before each reuse
+COURSE_CACHE_CONTROL = os.getenv("COURSE_CACHE_CONTROL", "public, no-cache")
+
+# Read-through cache for course detail and listing pages: in-process by default (COURSE_CACHE_SIZE
+# entries, 0 disables it), or shared by every instance when COURSE_CACHE_URL names a Redis server
+COURSE_CACHE_URL = os.getenv("COURSE_CACHE_URL")
+COURSE_CACHE_SIZE = int(os.getenv("COURSE_CACHE_SIZE", "4096"))
+COURSE_CACHE_TTL = float(os.getenv("COURSE_CACHE_TTL", "300"))
+
+# An in-process cache only sees its own instance's writes. Listing pages are keyed by the collection
+# version and stay correct, but course entries are not, so without COURSE_CACHE_URL they are kept at
+# most COURSE_CACHE_LOCAL_TTL seconds, which bounds how stale another instance's reads can be
+COURSE_CACHE_LOCAL_TTL = float(os.getenv("COURSE_CACHE_LOCAL_TTL", "2"))
+COURSE_ENTRY_TTL = COURSE_CACHE_TTL if COURSE_CACHE_URL else min(COURSE_CACHE_TTL, COURSE_CACHE_LOCAL_TTL)
+
+# Users encoded per chunk of a streamed GET /users response
+USER_STREAM_BATCH = 200
+NDJSON_MIMETYPE = "application/x-ndjson"
+
+# Max number of courses accepted by one POST /courses/batch request
+MAX_BATCH_COURSES = int(os.getenv("MAX_BATCH_COURSES", "5000"))
+
+# PATCH /courses/<id>/students?async=true queues the change as a background job, applied
+# ENROLLMENT_JOB_CHUNK students per transaction by ENROLLMENT_JOB_WORKERS threads per instance
+ENROLLMENT_JOB_WORKERS = int(os.getenv("ENROLLMENT_JOB_WORKERS", "2"))
+ENROLLMENT_JOB_CHUNK = MAX_ENROLLMENT_CHANGES_PER_COMMIT
+
+# Most student IDs one ?async=true request may list
+MAX_ENROLLMENT_JOB_IDS = int(os.getenv("MAX_ENROLLMENT_JOB_IDS", "20000"))
+
+# A queued or running job updates its status at least after every chunk. One not updated for
+# ENROLLMENT_JOB_STALE_AFTER seconds was lost with its instance, and is reported as failed
+ENROLLMENT_JOB_STALE_AFTER = float(os.getenv("ENROLLMENT_JOB_STALE_AFTER", "900"))
+
+# ISO 8601 UTC timestamps, as stored on enrollment jobs
+TIMESTAMP_FORMAT = "%Y-%m-%dT%H:%M:%SZ"
+
+# A job keeps the first MAX_JOB_FAILURES per-ID failures and counts the rest, so its status
+# entity stays far below Datastore's 1 MiB entity limit however many IDs fail
+MAX_JOB_FAILURES = 100
+
+# Per-caller token buckets: RATE_LIMIT_RATE requests per second with bursts of RATE_LIMIT_BURST
+# (RATE_LIMIT_RATE=0 turns rate limiting off). The full-scan routes in EXPENSIVE_ENDPOINTS share a
+# separate, smaller budget (RATE_LIMIT_EXPENSIVE_RATE=0 puts them on the default budget). Buckets
+# are in-process unless RATE_LIMIT_URL names a shared Redis server
+RATE_LIMIT_RATE = float(os.getenv("RATE_LIMIT_RATE", "10"))
+RATE_LIMIT_BURST = int(os.getenv("RATE_LIMIT_BURST", "50"))
+RATE_LIMIT_EXPENSIVE_RATE = float(os.getenv("RATE_LIMIT_EXPENSIVE_RATE", "0.5"))
+RATE_LIMIT_EXPENSIVE_BURST = int(os.getenv("RATE_LIMIT_EXPENSIVE_BURST", "10"))
+RATE_LIMIT_URL = os.getenv("RATE_LIMIT_URL")
+EXPENSIVE_ENDPOINTS = ("get_all_users", "get_course_enrollment")
+UNLIMITED_ENDPOINTS = ("home", "get_metrics", "warmup")
+
+# On App Engine the front end sets X-Appengine-User-IP (dropping any copy sent by the client)
+ON_APP_ENGINE = bool(os.getenv("GAE_ENV"))
+
+# Requester lookups (JWT sub -> user entity) are cached per instance
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "1024"))
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "30"))
+
 
 app = Flask(__name__)
 
 # API programmed by Brett Sullivan 6-5-2025, Oregon State University, Sullbret@oregonstate.edu 
 
 
-datastore_client = gcloud_datastore.Client()
+# Helper function - the repository for TARPAULIN_BACKEND. On Datastore the client is wrapped
+# in a shim that records per-route call latency and entity counts.
+def create_repository():
+    if TARPAULIN_BACKEND == "sqlite":
+        return repository.SQLiteRepository(SQLITE_PATH)
+    return repository.DatastoreRepository(metrics.instrument_datastore(gcloud_datastore.Client()))
+
+
+# Users, courses and enrollments. The backend client is created on first use (or by the warmup
+# request), not at import, to keep instance startup short.
+if TARPAULIN_BACKEND not in ("sqlite", "datastore"):
+    raise ValueError(f"Unknown TARPAULIN_BACKEND: {TARPAULIN_BACKEND}")
+repo = repository.LazyRepository(create_repository)
+user_cache = TTLCache(maxsize=USER_CACHE_SIZE, ttl=USER_CACHE_TTL)
+token_cache = TTLCache(maxsize=TOKEN_CACHE_SIZE, ttl=0)
+io_executor = ThreadPoolExecutor(max_workers=IO_POOL_SIZE, thread_name_prefix="tarpaulin-io")
+enrollment_jobs = jobs.JobQueue(workers=ENROLLMENT_JOB_WORKERS, name="enrollment-jobs")
+
+# Avatar payloads keyed by (user_id, blob generation), so a new upload never hits a stale entry
+avatar_cache = ByteLRUCache(AVATAR_CACHE_BYTES, max_item_bytes=AVATAR_CACHE_MAX_ITEM_BYTES)
+
+# Course records and listing pages, as JSON text
+if COURSE_CACHE_URL:
+    course_cache = RedisCache.from_url(COURSE_CACHE_URL, ttl=COURSE_CACHE_TTL)
+elif COURSE_CACHE_SIZE > 0:
+    course_cache = TTLCache(maxsize=COURSE_CACHE_SIZE, ttl=COURSE_CACHE_TTL)
+else:
+    course_cache = None
+
+# Token buckets for admission control, keyed by JWT sub or client IP
+if RATE_LIMIT_RATE <= 0:
+    rate_limiter = None
+else:
+    rate_limiter = ratelimit.RateLimiter(
+        ratelimit.RedisBucketStore.from_url(RATE_LIMIT_URL) if RATE_LIMIT_URL else ratelimit.LocalBucketStore(),
+        default=ratelimit.Limit(RATE_LIMIT_RATE, RATE_LIMIT_BURST),
+        expensive=ratelimit.Limit(RATE_LIMIT_EXPENSIVE_RATE, RATE_LIMIT_EXPENSIVE_BURST)
+        if RATE_LIMIT_EXPENSIVE_RATE > 0 else None,
+        expensive_endpoints=EXPENSIVE_ENDPOINTS
+    )
+
+# Cached in place of a deleted course so a read-through fill racing the delete can't restore it
+COURSE_TOMBSTONE = "null"
+
+# In-memory copy of a small blob; has the metadata attributes send_blob reads
+CachedBlob = namedtuple("CachedBlob", ["data", "etag", "updated", "size"])
+
+# Cloud Storage client and bucket handle shared by all requests, created on first use
+_storage_lock = threading.Lock()
+_storage_client = None
+_photo_bucket = None
+
+
+# Helper function - the process-wide Cloud Storage client, backed by a pooled keep-alive session
+def get_storage_client():
+    global _storage_client
+    if _storage_client is None:
+        with _storage_lock:
+            if _storage_client is None:
+                # Imported here: the storage library is slow to import and only some routes need it
+                from google.auth.transport.requests import AuthorizedSession
+                from google.cloud import storage
+                credentials, project = google.auth.default(scopes=storage.Client.SCOPE)
+                session = AuthorizedSession(credentials)
+                adapter = HTTPAdapter(pool_connections=STORAGE_POOL_SIZE, pool_maxsize=STORAGE_POOL_SIZE)
+                session.mount("https://", adapter)
+                _storage_client = storage.Client(project=project, credentials=credentials, _http=session)
+    return _storage_client
+
+
+# Helper function - the shared PHOTO_BUCKET handle (no metadata RPC)
+def get_photo_bucket():
+    global _photo_bucket
+    if _photo_bucket is None:
+        bucket = metrics.instrument_bucket(get_storage_client().bucket(PHOTO_BUCKET))
+        with _storage_lock:
+            if _photo_bucket is None:
+                _photo_bucket = bucket
+    return _photo_bucket
+
+
+# Helper function - read bytes [start, stop) of a blob in chunks, pinned to its generation
+def iter_blob_range(blob, start, stop):
+    position = start
+    while position < stop:
+        chunk_stop = min(position + STREAM_CHUNK_SIZE, stop)
+        yield blob.download_as_bytes(start=position, end=chunk_stop - 1)
+        position = chunk_stop
+
+
+# Helper function - how the request is answered for a blob, from its metadata alone: returns
+# (status, start, stop) with status 304 (If-None-Match/If-Modified-Since), 416 (unsatisfiable
+# Range), 206 (single Range) or 200, and [start, stop) the bytes to send
+def plan_blob_response(blob):
+    size = blob.size or 0
+
+    if request.if_none_match:
+        not_modified = request.if_none_match.contains_weak(blob.etag)
+    else:
+        not_modified = bool(request.if_modified_since and blob.updated
+                            and blob.updated.replace(microsecond=0) <= request.if_modified_since)
+    if not_modified:
+        return 304, 0, 0
+
+    # Only a single range is served; a multi-range request gets the whole blob, which RFC 9110 allows
+    if request.range and len(request.range.ranges) == 1 and range_still_valid(blob):
+        byte_range = request.range.range_for_length(size)
+        if byte_range is None:
+            return 416, 0, 0
+        return (206,) + byte_range
+    return 200, 0, size
+
+
+# Helper function - stream a blob (loaded with metadata, e.g. via get_blob) to the client, as
+# planned by plan_blob_response. read_range(blob, start, stop) yields the body; defaults to
+# ranged GCS reads.
+def send_blob(blob, mimetype, download_name, read_range=None):
+    size = blob.size or 0
+    read_range = read_range or iter_blob_range
+
+    status, start, stop = plan_blob_response(blob)
+    if status == 416:
+        response = Response(status=416)
+        response.headers["Content-Range"] = f"bytes */{size}"
+        return response
+
+    body = iter_in_context(read_range(blob, start, stop)) if status != 304 else None
+    response = Response(body, status=status, mimetype=mimetype, direct_passthrough=True)
+    response.set_etag(blob.etag)
+    response.last_modified = blob.updated
+    response.headers["Accept-Ranges"] = "bytes"
+    if status != 304:
+        response.headers["Content-Length"] = str(stop - start)
+        response.headers.set("Content-Disposition", "inline", filename=download_name)
+    if status == 206:
+        response.headers["Content-Range"] = f"bytes {start}-{stop - 1}/{size}"
+    return response
+
+
+# Helper function - advance a response body generator inside the contextvars context current
+# when this is called (not at the first next(), which runs after the request's after_request
+# hooks), so backend calls made while the body streams are still attributed to this request's route
+def iter_in_context(iterable):
+    context = contextvars.copy_context()
+    iterator = iter(iterable)
+
+    def advance():
+        while True:
+            try:
+                yield context.run(next, iterator)
+            except StopIteration:
+                return
+
+    return advance()
+
+
+# Helper function - body reader for send_blob over a CachedBlob
+def iter_cached_range(cached, start, stop):
+    yield cached.data[start:stop]
+
+
+# Helper function - object name of a user's avatar, or of one of its downscaled variants
+def avatar_blob_name(user_id, size=None):
+    if size is None:
+        return f"avatars/{user_id}.png"
+    return f"avatars/{user_id}_{size}.png"
+
+
+# Helper function - stream the request's PNG 'file' part into the blob blob_for(filename) returns
+# (nowhere when blob_for is None). Returns (form, upload, None), or (None, None, error response)
+# when the upload is rejected, in which case nothing was stored
+def receive_png_upload(blob_for=None, decode=False):
+    open_sink = None
+    if blob_for is not None:
+        open_sink = lambda filename: uploads.BlobUpload(blob_for(filename), UPLOAD_CHUNK_SIZE)
+    try:
+        form, upload = uploads.receive_png(request.environ, MAX_UPLOAD_BYTES, open_sink, decode)
+    except uploads.UploadTooLarge:
+        return None, None, (jsonify({"Error": "The uploaded file is too large"}), 413)
+    except uploads.InvalidUpload:
+        return None, None, (jsonify({"Error": "The request body is invalid"}), 400)
+    return form, upload, None
+
+
+# Helper function - PNG bytes of `image` scaled down so its longest side is `size` pixels.
+# Only reads `image`, so several variants can be rendered from it in parallel.
+def render_avatar_variant(image, size):
+    scale = size / max(image.size)
+    target = (max(1, round(image.width * scale)), max(1, round(image.height * scale)))
+    variant = image.resize(target, Image.Resampling.LANCZOS, reducing_gap=3.0)
+    out = io.BytesIO()
+    variant.save(out, format="PNG")
+    return out.getvalue()
+
+
+# Helper function - smallest stored variant at least `size` pixels; None means the original
+def pick_avatar_variant(variants, size):
+    if size is None:
+        return None
+    return min((variant for variant in variants if variant >= size), default=None)
+
+
+# Helper function - delete a blob; False if it didn't exist
+def delete_blob(bucket, name):
+    try:
+        bucket.blob(name).delete()
+    except NotFound:
+        return False
+    return True
+
+
+# Helper function - drop every cached generation of a user's avatar
+def evict_cached_avatar(user_id):
+    avatar_cache.delete_matching(lambda key: key[0] == user_id)
+
+
+# Helper function - honour If-Range: only serve a partial response for an unchanged blob
+def range_still_valid(blob):
+    if_range = request.if_range
+    if if_range.etag:
+        return if_range.etag == blob.etag
+    if if_range.date and blob.updated:
+        return blob.updated.replace(microsecond=0) <= if_range.date
+    return True
+
+# Record per-route latency and backend calls for every request, once its body has been sent
+@app.before_request
+def start_request_metrics():
+    g.metrics_scope = metrics.registry.start_request(request.endpoint or "unmatched")
+
+
+@app.after_request
+def finish_request_metrics(response):
+    scope = g.pop("metrics_scope", None)
+    if scope is not None:
+        response.call_on_close(metrics.registry.finish_request(
+            scope, request.endpoint or "unmatched", request.method, response.status_code))
+    return response
+
+
+# Refuse callers over their request budget before the route does any work
+@app.before_request
+def enforce_rate_limit():
+    if rate_limiter is None or request.endpoint in UNLIMITED_ENDPOINTS:
+        return None
+    sub, error_msg, status = verify_jwt_and_get_sub()
+    caller = f"sub:{sub}" if sub else f"ip:{client_ip()}"
+    retry_after = rate_limiter.check(caller, request.endpoint or "unmatched")
+    if retry_after:
+        response = jsonify({"Error": "Too many requests"})
+        response.headers["Retry-After"] = str(retry_after)
+        return response, 429
+    return None
+
+
+# Helper function - the client's address, as seen by App Engine's front end when deployed there
+def client_ip():
+    if ON_APP_ENGINE and request.headers.get("X-Appengine-User-IP"):
+        return request.headers["X-Appengine-User-IP"]
+    return request.remote_addr
+
+
+# Export in-process cache counters alongside the request metrics
+def cache_metrics():
+    stats = avatar_cache.stats()
+    events = [((("event", event),), stats[key]) for event, key in
+              (("hit", "hits"), ("miss", "misses"), ("eviction", "evictions"))]
+    return (
+        metrics.render_gauges("tarpaulin_avatar_cache_events_total", "Avatar cache lookups and evictions.",
+                              events, metric_type="counter")
+        + metrics.render_gauges("tarpaulin_avatar_cache_bytes", "Bytes held by the avatar cache.",
+                                [((), stats["bytes"])])
+        + metrics.render_gauges("tarpaulin_avatar_cache_entries", "Avatars held by the avatar cache.",
+                                [((), stats["entries"])])
+    )
+
+
+metrics.registry.add_collector(cache_metrics)
+
+request_profiler = profiler.install(app, profiler.SamplingProfiler(
+    slow_ms=PROFILE_SLOW_MS,
+    sample_rate=PROFILE_SAMPLE_RATE,
+    interval_ms=PROFILE_INTERVAL_MS,
+    output_dir=PROFILE_DIR,
+    output_format=PROFILE_FORMAT
+))
+
 
 # Basic home / route 
 @app.route('/')
@@ -70,23 +487,340 @@ def user_login():
 
 
 
-# Helper function for routes
+# JWKS client that throttles the key set refetch done for unknown kids
+class Auth0JWKClient(jwt.PyJWKClient):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._last_refresh = float("-inf")
+        self._refresh_lock = threading.Lock()
+
+    def get_signing_keys(self, refresh=False):
+        if refresh:
+            with self._refresh_lock:
+                now = time.monotonic()
+                if now - self._last_refresh < JWKS_MIN_REFRESH:
+                    refresh = False
+                else:
+                    self._last_refresh = now
+        return super().get_signing_keys(refresh)
+
+
+_jwks_lock = threading.Lock()
+_jwks_client = None
+
+
+# Helper function - the process-wide JWKS client, created on first use
+def get_jwks_client():
+    global _jwks_client
+    if _jwks_client is None:
+        with _jwks_lock:
+            if _jwks_client is None:
+                _jwks_client = Auth0JWKClient(AUTH0_JWKS_URL, cache_keys=True, lifespan=JWKS_CACHE_TTL)
+    return _jwks_client
+
+
+# Helper function - verify a token's signature, audience, issuer and expiry
+def decode_verified_jwt(token):
+    signing_key = get_jwks_client().get_signing_key_from_jwt(token)
+    return jwt.decode(
+        token,
+        signing_key.key,
+        algorithms=["RS256"],
+        audience=AUTH0_AUDIENCE,
+        issuer=AUTH0_ISSUER,
+        options={"require": ["exp", "sub"]}
+    )
+
+
+# Helper function for routes; the result is kept for the rest of the request, since the
+# rate limiter already checks the token before the route runs
 def verify_jwt_and_get_sub():
+    if "jwt_result" not in g:
+        g.jwt_result = check_bearer_token()
+    return g.jwt_result
+
+
+# Helper function - (sub, None, None) for a valid bearer token, else (None, error, status)
+def check_bearer_token():
     auth_header = request.headers.get('Authorization')
     if not auth_header or not auth_header.startswith("Bearer "):
         return None, "Missing or invalid Authorization header", 401
 
     token = auth_header.split(" ")[1]
+
+    # Repeat callers skip signature checks and parsing until the token expires
+    token_hash = hashlib.sha256(token.encode()).hexdigest()
+    claims = token_cache.get(token_hash)
+    if claims is None:
+        try:
+            claims = decode_verified_jwt(token)
+        except Exception:
+            return None, "Unauthorized", 401
+        token_cache.set(token_hash, claims, ttl=claims["exp"] - time.time())
+
+    if claims["exp"] <= time.time():
+        token_cache.delete(token_hash)
+        return None, "Unauthorized", 401
+    return claims["sub"], None, None
+
+
+# Helper function - resolve the user record for a JWT sub.
+# Results are cached by sub, so callers must treat the record as read-only.
+def get_user_by_sub(sub):
+    if not sub:
+        return None
+    user = user_cache.get(sub)
+    if user is not None:
+        return user
+
+    user = repo.find_user_by_sub(sub)
+    if user is None:
+        return None
+    user_cache.set(sub, user)
+    return user
+
+
+# Helper function - run independent backend calls in parallel; results come back in call order.
+# The first call runs on the request thread, the rest on the shared io_executor with a copy
+# of the caller's contextvars. Calls must not touch the Flask request context.
+def run_concurrently(*calls):
+    futures = [io_executor.submit(contextvars.copy_context().run, call) for call in calls[1:]]
+    results = [calls[0]()]
+    results.extend(future.result() for future in futures)
+    return results
+
+
+# Helper function - current UTC time as an ISO 8601 string, and back to seconds since the epoch
+def utc_timestamp():
+    return time.strftime(TIMESTAMP_FORMAT, time.gmtime())
+
+
+def parse_utc_timestamp(timestamp):
+    return calendar.timegm(time.strptime(timestamp, TIMESTAMP_FORMAT))
+
+
+# Helper function - mark a queued or running job failed once its status has gone
+# ENROLLMENT_JOB_STALE_AFTER seconds without an update. Returns the job
+def expire_stale_job(job):
+    if job["status"] in ("queued", "running") and \
+            time.time() - parse_utc_timestamp(job["updated"]) > ENROLLMENT_JOB_STALE_AFTER:
+        job["status"] = "failed"
+        job["error"] = "The job stopped before finishing; resubmit the change"
+        job["updated"] = utc_timestamp()
+        repo.save_job(job)
+    return job
+
+
+# Helper function - the response body describing an enrollment job
+def job_summary(job):
+    summary = {
+        "id": job.id,
+        "course_id": job["course_id"],
+        "status": job["status"],
+        "total": job["total"],
+        "processed": job["processed"],
+        "failed": job["failed"],
+        "failures": job["failures"],
+        "created": job["created"],
+        "updated": job["updated"],
+        "self": f"{request.host_url.rstrip('/')}/courses/{job['course_id']}/students/jobs/{job.id}"
+    }
+    if job.get("error"):
+        summary["Error"] = job["error"]
+    return summary
+
+
+# Helper function - background worker for an enrollment job. Applies the change one chunk per
+# transaction; IDs that aren't students are recorded as failures instead of failing the job
+def run_enrollment_job(job_id, add_ids, remove_ids):
+    metrics.current_route.set("enrollment_job")
+    job = repo.get_job(job_id)
+    # Already reported as failed after waiting too long in the queue
+    if job["status"] != "queued":
+        return
+    course_id = job["course_id"]
+    job["status"] = "running"
+    job["updated"] = utc_timestamp()
+    repo.save_job(job)
+
+    changes = [(sid, "add") for sid in add_ids] + [(sid, "remove") for sid in remove_ids]
     try:
-        # This decodes without verifying signature (sufficient for our needs if audience is correct)
-        decoded = jwt.decode(token, options={"verify_signature": False}, audience=AUTH0_AUDIENCE)
-        sub = decoded.get("sub")
-        return sub, None, None
+        for chunk in chunked(changes, ENROLLMENT_JOB_CHUNK):
+            students = {user.id for user in repo.get_users([sid for sid, _ in chunk]) if user["role"] == "student"}
+            failures = [{"id": sid, "action": action, "Error": "Not a student"}
+                        for sid, action in chunk if sid not in students]
+            valid = [(sid, action) for sid, action in chunk if sid in students]
+            if valid:
+                try:
+                    changed_students = repo.update_enrollment(
+                        course_id,
+                        [sid for sid, action in valid if action == "add"],
+                        [sid for sid, action in valid if action == "remove"]
+                    )
+                except InvalidEnrollment:
+                    # A student was deleted or changed role after the lookup above
+                    failures += [{"id": sid, "action": action, "Error": "Enrollment data is invalid"}
+                                 for sid, action in valid]
+                else:
+                    evict_course(course_id)
+                    invalidate_cached_users(changed_students)
+
+            job["processed"] += len(chunk)
+            job["failed"] += len(failures)
+            job["failures"] += failures[:MAX_JOB_FAILURES - len(job["failures"])]
+            job["updated"] = utc_timestamp()
+            repo.save_job(job)
+        job["status"] = "completed"
+    except CourseNotFound:
+        job["status"] = "failed"
+        job["error"] = "Course not found"
     except Exception:
-        return None, "Unauthorized", 401
-    
+        job["status"] = "failed"
+        job["error"] = "Internal error"
+        raise
+    finally:
+        job["updated"] = utc_timestamp()
+        repo.save_job(job)
+
+
+# Helper function - validate a course body; raises KeyError/TypeError/ValueError if invalid
+def parse_course_body(body):
+    return {
+        "subject": body["subject"],
+        "number": int(body["number"]),
+        "title": body["title"],
+        "term": body["term"],
+        "instructor_id": int(body["instructor_id"])
+    }
+
+
+# Helper function - JSON representation of a course record
+def course_to_json(course):
+    return {
+        "id": course.id,
+        "subject": course["subject"],
+        "number": course["number"],
+        "title": course["title"],
+        "term": course["term"],
+        "instructor_id": course["instructor_id"],
+        "self": f"{request.host_url.rstrip('/')}/courses/{course.id}"
+    }
+
+
+# Helper function - ETag of a course, derived from its version counter
+def course_etag(course):
+    return f"course-{course.id}-v{course.get('version', 0)}"
+
+
+# Helper function - 304 if the client already holds `etag`, otherwise the JSON from build().
+# Either way the response carries the ETag and COURSE_CACHE_CONTROL.
+def conditional_json(etag, build):
+    if request.if_none_match.contains_weak(etag):
+        response = Response(status=304)
+    else:
+        response = jsonify(build())
+    response.set_etag(etag)
+    response.headers["Cache-Control"] = COURSE_CACHE_CONTROL
+    return response
 
-# Route 2 - GET all users route, only 200 for admin
+
+# Helper function - cacheable form of a course record (its fields plus its id) and back
+def course_cache_fields(course):
+    return {"id": course.id, **course}
+
+
+def course_from_cache_fields(fields):
+    fields = dict(fields)
+    return repository.Record(fields.pop("id"), fields)
+
+
+# Helper function - read-through course lookup for GET /courses/<id>.
+# Fills only add entries while writes overwrite them (cache_course / tombstone_course),
+# so a fill that read the course before a write can never replace the newer entry.
+def get_course_cached(course_id):
+    if course_cache is None:
+        return repo.get_course(course_id)
+    key = f"course:{course_id}"
+    text = course_cache.get(key)
+    if text is not None:
+        return None if text == COURSE_TOMBSTONE else course_from_cache_fields(json.loads(text))
+
+    course = repo.get_course(course_id)
+    if course is not None:
+        course_cache.add(key, json.dumps(course_cache_fields(course)), ttl=COURSE_ENTRY_TTL)
+    return course
+
+
+# Helper function - store a course just created or updated
+def cache_course(course):
+    if course_cache is not None:
+        course_cache.set(f"course:{course.id}", json.dumps(course_cache_fields(course)), ttl=COURSE_ENTRY_TTL)
+
+
+# Helper function - mark a course deleted
+def tombstone_course(course_id):
+    if course_cache is not None:
+        course_cache.set(f"course:{course_id}", COURSE_TOMBSTONE, ttl=COURSE_ENTRY_TTL)
+
+
+# Helper function - drop a course's entry (e.g. after an enrollment change)
+def evict_course(course_id):
+    if course_cache is not None:
+        course_cache.delete(f"course:{course_id}")
+
+
+# Helper function - read-through page of GET /courses. Pages are keyed by the courses
+# collection version, so every course write makes all earlier pages unreachable.
+def list_courses_cached(version, limit, cursor, offset):
+    if course_cache is None:
+        return repo.list_courses(limit, cursor=cursor, offset=offset)
+    key = f"courses:v{version}:{limit}:{offset}:{cursor or ''}"
+    text = course_cache.get(key)
+    if text is not None:
+        page = json.loads(text)
+        return [course_from_cache_fields(course) for course in page["courses"]], page["next"]
+
+    courses, next_cursor = repo.list_courses(limit, cursor=cursor, offset=offset)
+    page = {"courses": [course_cache_fields(course) for course in courses], "next": next_cursor}
+    course_cache.add(key, json.dumps(page))
+    return courses, next_cursor
+
+
+# Helper function - JSON representation of a user in listings
+def user_summary(user):
+    return {
+        "id": user.id,
+        "role": user["role"],
+        "sub": user["sub"]
+    }
+
+
+# Helper function - encode users as a JSON array (or NDJSON, one user per line) chunk by chunk
+def stream_users(users, ndjson):
+    if not ndjson:
+        yield "["
+    separator = ""
+    for batch in chunked(users, USER_STREAM_BATCH):
+        lines = [json.dumps(user_summary(user)) for user in batch]
+        if ndjson:
+            yield "\n".join(lines) + "\n"
+        else:
+            yield separator + ",".join(lines)
+            separator = ","
+    if not ndjson:
+        yield "]"
+
+
+# Helper function - drop cached copies of users whose record was rewritten
+def invalidate_cached_users(users):
+    for user in users:
+        if user is not None and user.get("sub"):
+            user_cache.delete(user["sub"])
+
+
+# Route 2 - GET all users route, only 200 for admin.
+# With ?limit= (and ?cursor=) returns one page, otherwise streams every user.
+# Responds with NDJSON for ?format=ndjson or "Accept: application/x-ndjson".
 @app.route('/users', methods=['GET'])
 def get_all_users():
     sub, error_msg, status = verify_jwt_and_get_sub()
@@ -94,26 +828,52 @@ def get_all_users():
         return jsonify({"Error": error_msg}), status
 
     # Get user entity by sub
-    query = datastore_client.query(kind="users")
-    query.add_filter("sub", "=", sub)
-    results = list(query.fetch())
-    if not results:
+    requester = get_user_by_sub(sub)
+    if not requester:
         return jsonify({"Error": "You don't have permission on this resource"}), 403
-    if results[0]['role'] != "admin":
+    if requester['role'] != "admin":
         return jsonify({"Error": "You don't have permission on this resource"}), 403
 
-    # Get all users and return only id, role, sub
-    query = datastore_client.query(kind="users")
-    all_users = query.fetch()
-    user_list = []
-    for user in all_users:
-        user_list.append({
-            "id": user.key.id,
-            "role": user["role"],
-            "sub": user["sub"]
-        })
+    ndjson = (request.args.get('format') == "ndjson"
+              or request.accept_mimetypes.best_match(["application/json", NDJSON_MIMETYPE]) == NDJSON_MIMETYPE)
+    mimetype = NDJSON_MIMETYPE if ndjson else "application/json"
 
-    return jsonify(user_list), 200
+    # Full export: streamed from a projection on (role, sub) in constant memory
+    cursor = request.args.get('cursor')
+    if 'limit' not in request.args and not cursor:
+        return Response(iter_in_context(stream_users(repo.iter_users(), ndjson)), mimetype=mimetype)
+
+    # One page, with a "next" link carrying an opaque cursor if the page was full
+    try:
+        limit = int(request.args.get('limit', MAX_PAGE_LIMIT))
+    except ValueError:
+        return jsonify({"Error": "Invalid query parameters"}), 400
+    if limit < 1:
+        return jsonify({"Error": "Invalid query parameters"}), 400
+    limit = min(limit, MAX_PAGE_LIMIT)
+    try:
+        users, next_cursor = repo.list_users(limit, cursor=cursor)
+    except ValueError:
+        return jsonify({"Error": "Invalid query parameters"}), 400
+
+    next_link = None
+    if len(users) == limit and next_cursor:
+        query_string = urlencode({"limit": limit, "cursor": next_cursor})
+        next_link = f"{request.host_url.rstrip('/')}/users?{query_string}"
+
+    # NDJSON pages carry the next link in a Link header
+    if ndjson:
+        response = Response(stream_users(users, ndjson=True), mimetype=mimetype)
+        if next_link:
+            response.headers["Link"] = f'<{next_link}>; rel="next"'
+        return response
+
+    response = {
+        "users": [user_summary(user) for user in users]
+    }
+    if next_link:
+        response["next"] = next_link
+    return jsonify(response), 200
 
 
 
@@ -125,42 +885,36 @@ def get_user(user_id):
     if error_msg:
         return jsonify({"Error": error_msg}), status
 
-    # Get requesting user
-    query = datastore_client.query(kind="users")
-    query.add_filter("sub", "=", sub)
-    requester = list(query.fetch())
+    # Get requesting user and target user concurrently
+    requester, user = run_concurrently(
+        lambda: get_user_by_sub(sub),
+        lambda: repo.get_user(user_id)
+    )
 
     if not requester:
         return jsonify({"Error": "Forbidden"}), 403
 
-    requester_role = requester[0]["role"]
-
-    # Get target user
-    key = datastore_client.key("users", user_id)
-    user = datastore_client.get(key)
+    requester_role = requester["role"]
 
     if not user:
         return jsonify({"Error": "Forbidden"}), 403
 
-    if requester_role != "admin" and requester[0].key.id != user_id:
+    if requester_role != "admin" and requester.id != user_id:
         return jsonify({"Error": "You don't have permission on this resource"}), 403
 
     user_data = {
-        "id": user.key.id,
+        "id": user.id,
         "role": user["role"],
         "sub": user["sub"]
     }
 
-    # Check if avatar file exists in GCS
-    storage_client = storage.Client()
-    bucket = storage_client.bucket(PHOTO_BUCKET)
-    blob = bucket.blob(f"avatars/{user.key.id}.png")
-    if blob.exists():
-        user_data["avatar_url"] = f"{request.host_url.rstrip('/')}/users/{user.key.id}/avatar"
+    # Avatar presence is tracked on the user record, so no GCS round-trip is needed
+    if user.get("has_avatar"):
+        user_data["avatar_url"] = f"{request.host_url.rstrip('/')}/users/{user.id}/avatar"
 
     # Add courses only for instructors and students
     if user["role"] in ["instructor", "student"]:
-        course_ids = user.get("courses", [])
+        course_ids = repo.get_user_course_ids(user)
         course_links = [f"http://localhost:8080/courses/{course_id}" for course_id in course_ids]
         user_data["courses"] = course_links
 
@@ -171,34 +925,52 @@ def get_user(user_id):
 # Route 4 - POST - Creat/Update a users avatar
 @app.route('/users/<int:user_id>/avatar', methods=['POST'])
 def upload_avatar(user_id):
-    # Step 1: Check for 'file' in request
-    if 'file' not in request.files:
-        return jsonify({"Error": "The request body is invalid"}), 400
-
-    file_obj = request.files['file']
-
-    # Step 2: Verify JWT and match sub with user_id
+    # Step 1: Verify JWT and match sub with user_id. Only headers are needed, so this happens
+    # before the body is read; the outcome is reported after the body has been checked
     sub, error_msg, status = verify_jwt_and_get_sub()
+    user = None
+    if not error_msg:
+        user = repo.get_user(user_id)
+        if not user:
+            error_msg, status = "User not found", 403
+        elif user["sub"] != sub:
+            error_msg, status = "You don't have permission on this resource", 403
+            user = None
+
+    # Step 2: Receive the 'file' part. Its size and PNG signature are checked as it arrives;
+    # the owner's upload streams straight to GCS and is decoded for the variants on the way
+    bucket = get_photo_bucket()
+    blob_for = (lambda filename: bucket.blob(avatar_blob_name(user_id))) if user else None
+    _, upload, error = receive_png_upload(blob_for, decode=user is not None)
+    if error:
+        return error
     if error_msg:
         return jsonify({"Error": error_msg}), status
 
-    # Get user entity from Datastore
-    user_key = datastore_client.key("users", user_id)
-    user = datastore_client.get(user_key)
-    if not user:
-        return jsonify({"Error": "User not found"}), 403
-
-    if user["sub"] != sub:
-        return jsonify({"Error": "You don't have permission on this resource"}), 403
-
-    # Step 3: Upload to GCS
-    storage_client = storage.Client()
-    bucket = storage_client.bucket(PHOTO_BUCKET)
-    blob = bucket.blob(f"avatars/{user_id}.png")
-    file_obj.seek(0)
-    blob.upload_from_file(file_obj, content_type="image/png")
-
-    # Step 4: Return the avatar URL
+    # Step 3: Pick the variants smaller than the original
+    image = upload.image
+    if image.mode not in ("RGB", "RGBA", "L", "LA"):
+        image = image.convert("RGBA")
+    sizes = [size for size in AVATAR_VARIANT_SIZES if size < max(image.size)]
+    stale_sizes = [size for size in user.get("avatar_variants", []) if size not in sizes]
+
+    # Step 4: Commit the original and render/upload each variant in parallel,
+    # removing variants a previous, larger upload left behind
+    def upload_variant(size):
+        variant = bucket.blob(avatar_blob_name(user_id, size))
+        variant.upload_from_string(render_avatar_variant(image, size), content_type="image/png")
+
+    blob = run_concurrently(
+        upload.commit,
+        *[lambda size=size: upload_variant(size) for size in sizes],
+        *[lambda size=size: delete_blob(bucket, avatar_blob_name(user_id, size)) for size in stale_sizes]
+    )[0]
+
+    # Step 5: Record the avatar and its variants on the user record (its avatar fields only)
+    invalidate_cached_users([repo.set_avatar(user_id, blob.generation, sizes)])
+    evict_cached_avatar(user_id)
+
+    # Step 6: Return the avatar URL
     avatar_url = f"{request.host_url.rstrip('/')}/users/{user_id}/avatar"
     return jsonify({"avatar_url": avatar_url}), 200
 
@@ -212,29 +984,59 @@ def get_avatar(user_id):
     if error_msg:
         return jsonify({"Error": error_msg}), status
 
-    # Step 2: Get user from Datastore
-    user_key = datastore_client.key("users", user_id)
-    user = datastore_client.get(user_key)
+    # Step 2: Parse the optional ?size= (longest side in pixels)
+    size = request.args.get('size')
+    if size is not None:
+        try:
+            size = int(size)
+        except ValueError:
+            return jsonify({"Error": "Invalid query parameters"}), 400
+        if size < 1:
+            return jsonify({"Error": "Invalid query parameters"}), 400
+
+    # Step 3: Get the user record
+    user = repo.get_user(user_id)
     if not user:
         return jsonify({"Error": "You don't have permission on this resource"}), 403
 
-    # Step 3: Check if JWT belongs to this user
+    # Step 4: Check if JWT belongs to this user
     if user["sub"] != sub:
         return jsonify({"Error": "You don't have permission on this resource"}), 403
 
-    # Step 4: Access GCS and check if avatar exists
-    storage_client = storage.Client()
-    bucket = storage_client.bucket(PHOTO_BUCKET)
-    blob = bucket.blob(f"avatars/{user_id}.png")
-
-    if not blob.exists():
+    # Step 5: Serve the smallest variant that covers the requested size, else the original.
+    # Serve from the in-memory cache when this avatar generation is already there
+    variant = pick_avatar_variant(user.get("avatar_variants", []), size)
+    download_name = f"avatar_{variant}.png" if variant else "avatar.png"
+    generation = user.get("avatar_generation")
+    cached = avatar_cache.get((user_id, generation, variant)) if generation else None
+    if cached is not None:
+        return send_blob(cached, "image/png", download_name, read_range=iter_cached_range)
+
+    # Step 6: Load the avatar's metadata from GCS (None if there is no avatar)
+    bucket = get_photo_bucket()
+    blob = bucket.get_blob(avatar_blob_name(user_id, variant))
+    if blob is None and variant is not None:
+        variant, download_name = None, "avatar.png"
+        blob = bucket.get_blob(avatar_blob_name(user_id))
+
+    if blob is None:
         return jsonify({"Error": "Not found"}), 404
 
-    # Step 5: Serve the image file
-    file_obj = io.BytesIO()
-    blob.download_to_file(file_obj)
-    file_obj.seek(0)
-    return send_file(file_obj, mimetype="image/png", download_name="avatar.png"), 200
+    # Step 7: Without a generation on the user record, cache under the blob's own generation
+    if not generation:
+        generation = blob.generation
+        cached = avatar_cache.get((user_id, generation, variant))
+        if cached is not None:
+            return send_blob(cached, "image/png", download_name, read_range=iter_cached_range)
+
+    # Step 8: A small avatar that will be sent is downloaded whole and cached. 304 and 416 are
+    # answered from the metadata, and larger avatars are streamed
+    cacheable = blob.size is not None and blob.size <= avatar_cache.max_item_bytes
+    if cacheable and plan_blob_response(blob)[0] in (200, 206):
+        cached = CachedBlob(blob.download_as_bytes(), blob.etag, blob.updated, blob.size)
+        avatar_cache.set((user_id, generation, variant), cached, cached.size)
+        return send_blob(cached, "image/png", download_name, read_range=iter_cached_range)
+    return send_blob(blob, "image/png", download_name)
 
 
 
@@ -246,9 +1048,8 @@ def delete_avatar(user_id):
     if error_msg:
         return jsonify({"Error": error_msg}), status
 
-    # Step 2: Get user from Datastore
-    user_key = datastore_client.key("users", user_id)
-    user = datastore_client.get(user_key)
+    # Step 2: Get the user record
+    user = repo.get_user(user_id)
     if not user:
         return jsonify({"Error": "You don't have permission on this resource"}), 403
 
@@ -256,16 +1057,19 @@ def delete_avatar(user_id):
     if user["sub"] != sub:
         return jsonify({"Error": "You don't have permission on this resource"}), 403
 
-    # Step 4: Check for avatar in GCS
-    storage_client = storage.Client()
-    bucket = storage_client.bucket(PHOTO_BUCKET)
-    blob = bucket.blob(f"avatars/{user_id}.png")
+    # Step 4: Delete the avatar and its variants from GCS in parallel
+    # (a missing original means there is no avatar)
+    bucket = get_photo_bucket()
+    names = [avatar_blob_name(user_id)] + [avatar_blob_name(user_id, size) for size in user.get("avatar_variants", [])]
+    deleted = run_concurrently(*[lambda name=name: delete_blob(bucket, name) for name in names])[0]
+    evict_cached_avatar(user_id)
 
-    if not blob.exists():
-        return jsonify({"Error": "Not found"}), 404
+    # Step 5: Clear the avatar flag on the user record
+    if user.get("has_avatar") or "avatar_generation" in user:
+        invalidate_cached_users([repo.set_avatar(user_id, None)])
 
-    # Step 5: Delete the avatar
-    blob.delete()
+    if not deleted:
+        return jsonify({"Error": "Not found"}), 404
     return '', 204
 
 
@@ -279,52 +1083,88 @@ def create_course():
         return jsonify({"Error": error_msg}), status
 
     # Step 2: Ensure requester is an admin
-    query = datastore_client.query(kind="users")
-    query.add_filter("sub", "=", sub)
-    requester = list(query.fetch())
-    if not requester or requester[0]["role"] != "admin":
+    requester = get_user_by_sub(sub)
+    if not requester or requester["role"] != "admin":
         return jsonify({"Error": "You don't have permission on this resource"}), 403
 
     # Step 3: Validate request body
     try:
-        body = request.get_json()
-        subject = body["subject"]
-        number = int(body["number"])
-        title = body["title"]
-        term = body["term"]
-        instructor_id = int(body["instructor_id"])
+        fields = parse_course_body(request.get_json())
     except:
         return jsonify({"Error": "The request body is invalid"}), 400
+    instructor_id = fields["instructor_id"]
 
     # Step 4: Check instructor_id is valid and role = instructor
-    instructor_key = datastore_client.key("users", instructor_id)
-    instructor = datastore_client.get(instructor_key)
+    instructor = repo.get_user(instructor_id)
     if not instructor or instructor.get("role") != "instructor":
         return jsonify({"Error": "The request body is invalid"}), 400
 
     # Step 5: Create course
-    course_key = datastore_client.key("courses")
-    course = gcloud_datastore.Entity(key=course_key)
-    course.update({
-        "subject": subject,
-        "number": number,
-        "title": title,
-        "term": term,
-        "instructor_id": instructor_id
-    })
-    datastore_client.put(course)
+    course = repo.create_course(fields)
+    cache_course(course)
 
-    response = {
-        "id": course.key.id,
-        "subject": subject,
-        "number": number,
-        "title": title,
-        "term": term,
-        "instructor_id": instructor_id,
-        "self": f"{request.host_url.rstrip('/')}/courses/{course.key.id}"
-    }
+    response = jsonify(course_to_json(course))
+    response.set_etag(course_etag(course))
+    return response, 201
+
+
+# Route 7b: POST /courses/batch - create many courses in one request (admin only).
+# Responds with one result per submitted course, in order: created (201) or rejected (400).
+@app.route('/courses/batch', methods=['POST'])
+def create_courses_batch():
+    # Step 1: Verify JWT
+    sub, error_msg, status = verify_jwt_and_get_sub()
+    if error_msg:
+        return jsonify({"Error": error_msg}), status
+
+    # Step 2: Ensure requester is an admin
+    requester = get_user_by_sub(sub)
+    if not requester or requester["role"] != "admin":
+        return jsonify({"Error": "You don't have permission on this resource"}), 403
+
+    # Step 3: The body must be a non-empty array of course bodies
+    body = request.get_json(silent=True)
+    if not isinstance(body, list) or not body or len(body) > MAX_BATCH_COURSES:
+        return jsonify({"Error": "The request body is invalid"}), 400
+
+    results = [None] * len(body)
+    parsed = []
+    for index, item in enumerate(body):
+        try:
+            parsed.append((index, parse_course_body(item)))
+        except (KeyError, TypeError, ValueError):
+            results[index] = {"index": index, "status": 400, "Error": "The request body is invalid"}
+
+    # Step 4: Validate every referenced instructor with batched lookups
+    instructors = {user.id: user for user in repo.get_users({f["instructor_id"] for _, f in parsed})}
 
-    return jsonify(response), 201
+    valid = []
+    for index, fields in parsed:
+        instructor = instructors.get(fields["instructor_id"])
+        if not instructor or instructor.get("role") != "instructor":
+            results[index] = {"index": index, "status": 400, "Error": "The instructor_id is invalid"}
+            continue
+        valid.append((index, fields))
+
+    # Step 5: Write the valid courses in commit-sized batches
+    for chunk in chunked(valid, MAX_COURSES_PER_COMMIT):
+        try:
+            courses = repo.create_courses([fields for _, fields in chunk])
+        except Exception as e:
+            print("Exception:", e)
+            for index, _ in chunk:
+                results[index] = {"index": index, "status": 500, "Error": "The course could not be saved"}
+            continue
+        for (index, _), course in zip(chunk, courses):
+            cache_course(course)
+            results[index] = {"index": index, "status": 201, "course": course_to_json(course)}
+
+    created = sum(1 for result in results if result["status"] == 201)
+    return jsonify({
+        "created": created,
+        "rejected": len(results) - created,
+        "results": results
+    }), 200
 
 
 
@@ -332,67 +1172,61 @@ def create_course():
 # Route 8: GET /courses 
 @app.route('/courses', methods=['GET'])
 def get_all_courses():
-    # Step 1: Get optional limit/offset query parameters
+    # Step 1: Get optional limit and cursor (or legacy offset) query parameters
     try:
+        limit = int(request.args.get('limit', DEFAULT_COURSE_PAGE_LIMIT))
         offset = int(request.args.get('offset', 0))
-        limit = int(request.args.get('limit', 3))
+    except ValueError:
+        return jsonify({"Error": "Invalid query parameters"}), 400
+    if limit < 1 or offset < 0:
+        return jsonify({"Error": "Invalid query parameters"}), 400
+    limit = min(limit, MAX_PAGE_LIMIT)
+    cursor = request.args.get('cursor')
+
+    # Step 2: The page's ETag comes from the courses collection version, read before the
+    # page itself so a concurrent write can only make the ETag older than the data
+    version = repo.get_collection_version("courses")
+    page = hashlib.sha256(f"{request.host_url}|{limit}|{cursor}|{offset}".encode()).hexdigest()[:16]
+    etag = f"courses-v{version}-{page}"
+    if request.if_none_match.contains_weak(etag):
+        return conditional_json(etag, None)
+
+    # Step 3: Query courses and sort by subject, resuming from the cursor if given
+    try:
+        results, next_cursor = list_courses_cached(version, limit, cursor, offset)
     except ValueError:
         return jsonify({"Error": "Invalid query parameters"}), 400
 
-    # Step 2: Query courses and sort by subject
-    query = datastore_client.query(kind="courses")
-    query.order = ["subject"]
-    results = list(query.fetch(offset=offset, limit=limit))
-
-    # Step 3: Format each course entry
+    # Step 4: Format each course entry
     courses_list = []
     for course in results:
-        courses_list.append({
-            "id": course.key.id,
-            "subject": course["subject"],
-            "number": course["number"],
-            "title": course["title"],
-            "term": course["term"],
-            "instructor_id": course["instructor_id"],
-            "self": f"{request.host_url.rstrip('/')}/courses/{course.key.id}"
-        })
+        courses_list.append(course_to_json(course))
 
-    # Step 4: Build response
+    # Step 5: Build response
     response = {
         "courses": courses_list
     }
 
-    # Add "next" link if number of courses equals the limit (optional per spec)
-    if len(results) == limit:
-        next_offset = offset + limit
-        response["next"] = f"{request.host_url.rstrip('/')}/courses?limit={limit}&offset={next_offset}"
+    # Add "next" link (an opaque cursor) if the page was full
+    if len(results) == limit and next_cursor:
+        query_string = urlencode({"limit": limit, "cursor": next_cursor})
+        response["next"] = f"{request.host_url.rstrip('/')}/courses?{query_string}"
 
-    return jsonify(response), 200
+    return conditional_json(etag, lambda: response)
 
 
 
 # Route 9 - GET a course by ID
 @app.route('/courses/<int:course_id>', methods=['GET'])
 def get_course(course_id):
-    # Step 1: Retrieve course from Datastore
-    course_key = datastore_client.key("courses", course_id)
-    course = datastore_client.get(course_key)
+    # Step 1: Retrieve the course (read-through cache)
+    course = get_course_cached(course_id)
 
     if not course:
         return jsonify({ "Error": "Not found" }), 404
 
-    # Step 2: Construct response (exclude students list)
-    response = {
-        "id": course.key.id,
-        "subject": course["subject"],
-        "number": course["number"],
-        "title": course["title"],
-        "term": course["term"],
-        "instructor_id": course["instructor_id"],
-        "self": f"{request.host_url.rstrip('/')}/courses/{course.key.id}"
-    }
-
-    return jsonify(response), 200
+    # Step 2: Construct response (exclude students list), or 304 if the client's copy is current
+    return conditional_json(course_etag(course), lambda: course_to_json(course))
 
 
 
@@ -406,16 +1240,15 @@ def update_course(course_id):
     if error_msg:
         return jsonify({"Error": "Unauthorized"}), 401
 
-    # Step 2: Ensure the user is an admin
-    query = datastore_client.query(kind="users")
-    query.add_filter("sub", "=", sub)
-    requester = list(query.fetch())
-    if not requester or requester[0].get("role") != "admin":
-        return jsonify({"Error": "You don't have permission on this resource"}), 403
+    # Step 2: Fetch the requester and the course concurrently
+    requester, course = run_concurrently(
+        lambda: get_user_by_sub(sub),
+        lambda: repo.get_course(course_id)
+    )
 
-    # Step 3: Fetch the course
-    course_key = datastore_client.key("courses", course_id)
-    course = datastore_client.get(course_key)
+    # Step 3: Ensure the user is an admin and the course exists
+    if not requester or requester.get("role") != "admin":
+        return jsonify({"Error": "You don't have permission on this resource"}), 403
     if not course:
         return jsonify({"Error": "You don't have permission on this resource"}), 403
 
@@ -429,8 +1262,7 @@ def update_course(course_id):
 
     # Step 5: Validate instructor_id if present
     if "instructor_id" in body:
-        instructor_key = datastore_client.key("users", body["instructor_id"])
-        instructor = datastore_client.get(instructor_key)
+        instructor = repo.get_user(body["instructor_id"])
         if not instructor or instructor.get("role") != "instructor":
             return jsonify({"Error": "The request body is invalid"}), 400
 
@@ -440,18 +1272,16 @@ def update_course(course_id):
         if field in body:
             course[field] = body[field]
 
-    # Step 7: Save and respond
-    datastore_client.put(course)
+    # Step 7: Save as the course's next version and respond
+    try:
+        repo.save_course(course)
+    except CourseNotFound:
+        return jsonify({"Error": "You don't have permission on this resource"}), 403
+    cache_course(course)
 
-    return jsonify({
-        "id": course.key.id,
-        "subject": course["subject"],
-        "number": course["number"],
-        "title": course["title"],
-        "term": course["term"],
-        "instructor_id": course["instructor_id"],
-        "self": f"{request.host_url.rstrip('/')}/courses/{course.key.id}"
-    }), 200
+    response = jsonify(course_to_json(course))
+    response.set_etag(course_etag(course))
+    return response, 200
 
 
 # Route 11 - DELETE a course
@@ -463,40 +1293,20 @@ def delete_course(course_id):
         return jsonify({"Error": "Unauthorized"}), 401
 
     # Step 2: Check if user is admin
-    query = datastore_client.query(kind="users")
-    query.add_filter("sub", "=", sub)
-    requester = list(query.fetch())
-    if not requester or requester[0]["role"] != "admin":
+    requester = get_user_by_sub(sub)
+    if not requester or requester["role"] != "admin":
         return jsonify({"Error": "You don't have permission on this resource"}), 403
 
-    # Step 3: Check if course exists
-    course_key = datastore_client.key("courses", course_id)
-    course = datastore_client.get(course_key)
-    if not course:
+    # Step 3: Delete the course and its enrollments, taking it off its instructor and students
+    try:
+        changed_users = repo.delete_course(course_id)
+    except CourseNotFound:
         return jsonify({"Error": "You don't have permission on this resource"}), 403
+    tombstone_course(course_id)
 
-    # Step 4: Remove course from instructor (if assigned)
-    instructor_id = course.get("instructor_id")
-    if instructor_id:
-        instructor_key = datastore_client.key("users", instructor_id)
-        instructor = datastore_client.get(instructor_key)
-        if instructor and "courses" in instructor:
-            instructor["courses"] = [cid for cid in instructor["courses"] if cid != course_id]
-            datastore_client.put(instructor)
-
-    # Step 5: Remove course from enrolled students
-    query = datastore_client.query(kind="users")
-    query.add_filter("role", "=", "student")
-    students = list(query.fetch())
-    for student in students:
-        if "courses" in student and course_id in student["courses"]:
-            student["courses"] = [cid for cid in student["courses"] if cid != course_id]
-            datastore_client.put(student)
-
-    # Step 6: Delete the course
-    datastore_client.delete(course_key)
-
-    # Step 7: Return 204 No Content
+    invalidate_cached_users(changed_users)
+
+    # Step 4: Return 204 No Content
     return ("", 204)
 
 
@@ -508,23 +1318,21 @@ def update_enrollment(course_id):
     if error_msg:
         return jsonify({"Error": "Unauthorized"}), 401
 
-    # Step 2: Get course
-    course_key = datastore_client.key("courses", course_id)
-    course = datastore_client.get(course_key)
+    # Step 2: Get course and requester user concurrently
+    course, requester = run_concurrently(
+        lambda: repo.get_course(course_id),
+        lambda: get_user_by_sub(sub)
+    )
     if not course:
         return jsonify({"Error": "You don't have permission on this resource"}), 403
 
-    # Step 3: Get requester user
-    query = datastore_client.query(kind="users")
-    query.add_filter("sub", "=", sub)
-    requester_list = list(query.fetch())
-    if not requester_list:
+    # Step 3: Check the requester exists
+    if not requester:
         return jsonify({"Error": "You don't have permission on this resource"}), 403
-    requester = requester_list[0]
 
     # Step 4: Check admin or instructor of the course
     is_admin = requester.get("role") == "admin"
-    is_instructor = (requester.get("role") == "instructor" and requester.key.id == course["instructor_id"])
+    is_instructor = (requester.get("role") == "instructor" and requester.id == course["instructor_id"])
     if not (is_admin or is_instructor):
         return jsonify({"Error": "You don't have permission on this resource"}), 403
 
@@ -543,38 +1351,70 @@ def update_enrollment(course_id):
     if add_ids & remove_ids:
         return jsonify({"Error": "Enrollment data is invalid"}), 409
 
-    # Step 7: Fetch all student users to validate roles
-    all_ids = add_ids | remove_ids
-    invalid = False
-    for uid in all_ids:
-        key = datastore_client.key("users", uid)
-        user = datastore_client.get(key)
-        if not user or user.get("role") != "student":
-            invalid = True
-            break
-    if invalid:
+    # Step 7: With ?async=true, queue the change as a background job and point at its status
+    if request.args.get('async') == 'true':
+        if len(add_ids) + len(remove_ids) > MAX_ENROLLMENT_JOB_IDS:
+            return jsonify({"Error": "The request body is invalid"}), 400
+        now = utc_timestamp()
+        job = repo.create_job({
+            "course_id": course_id,
+            "requester_id": requester.id,
+            "status": "queued",
+            "total": len(add_ids) + len(remove_ids),
+            "processed": 0,
+            "failed": 0,
+            "failures": [],
+            "created": now,
+            "updated": now
+        })
+        enrollment_jobs.submit(run_enrollment_job, job.id, list(add_ids), list(remove_ids))
+        summary = job_summary(job)
+        return jsonify(summary), 202, {"Location": summary["self"]}
+
+    # Step 8: Validate and apply the whole change
+    try:
+        changed_students = repo.update_enrollment(course_id, add_ids, remove_ids)
+    except CourseNotFound:
+        return jsonify({"Error": "You don't have permission on this resource"}), 403
+    except InvalidEnrollment:
         return jsonify({"Error": "Enrollment data is invalid"}), 409
 
-    # Step 8: Update student entities
-    for sid in add_ids:
-        key = datastore_client.key("users", sid)
-        student = datastore_client.get(key)
-        if "courses" not in student:
-            student["courses"] = []
-        if course_id not in student["courses"]:
-            student["courses"].append(course_id)
-        datastore_client.put(student)
-
-    for sid in remove_ids:
-        key = datastore_client.key("users", sid)
-        student = datastore_client.get(key)
-        if "courses" in student and course_id in student["courses"]:
-            student["courses"] = [cid for cid in student["courses"] if cid != course_id]
-            datastore_client.put(student)
+    evict_course(course_id)
+    invalidate_cached_users(changed_students)
 
     return '', 200
 
 
+# Route 12b - GET the progress of a background enrollment job
+@app.route('/courses/<int:course_id>/students/jobs/<int:job_id>', methods=['GET'])
+def get_enrollment_job(course_id, job_id):
+    # Step 1: Verify JWT
+    sub, error_msg, status = verify_jwt_and_get_sub()
+    if error_msg:
+        return jsonify({"Error": "Unauthorized"}), 401
+
+    # Step 2: Get course, requester user and job concurrently
+    course, requester, job = run_concurrently(
+        lambda: repo.get_course(course_id),
+        lambda: get_user_by_sub(sub),
+        lambda: repo.get_job(job_id)
+    )
+    if not course or not requester:
+        return jsonify({"Error": "You don't have permission on this resource"}), 403
+
+    # Step 3: Check admin or instructor of the course
+    is_admin = requester.get("role") == "admin"
+    is_instructor = (requester.get("role") == "instructor" and requester.id == course["instructor_id"])
+    if not (is_admin or is_instructor):
+        return jsonify({"Error": "You don't have permission on this resource"}), 403
+
+    # Step 4: The job must belong to this course
+    if not job or job["course_id"] != course_id:
+        return jsonify({"Error": "Not found"}), 404
+
+    return jsonify(job_summary(expire_stale_job(job))), 200
+
+
 # Route 13 - GET enrollment for a course 
 @app.route('/courses/<int:course_id>/students', methods=['GET'])
 def get_course_enrollment(course_id):
@@ -583,36 +1423,148 @@ def get_course_enrollment(course_id):
     if error_msg:
         return jsonify({"Error": "Unauthorized"}), 401
 
-    # Step 2: Retrieve course from Datastore
-    course_key = datastore_client.key("courses", course_id)
-    course = datastore_client.get(course_key)
+    # Step 2: Retrieve course and requester user concurrently
+    course, requester = run_concurrently(
+        lambda: repo.get_course(course_id),
+        lambda: get_user_by_sub(sub)
+    )
     if not course:
         return jsonify({"Error": "You don't have permission on this resource"}), 403
 
-    # Step 3: Get requester user
-    query = datastore_client.query(kind="users")
-    query.add_filter("sub", "=", sub)
-    requester_list = list(query.fetch())
-    if not requester_list:
+    # Step 3: Check the requester is admin or the course's instructor
+    if not requester:
         return jsonify({"Error": "You don't have permission on this resource"}), 403
 
-    requester = requester_list[0]
     is_admin = requester.get("role") == "admin"
-    is_instructor = (requester.get("role") == "instructor" and requester.key.id == course["instructor_id"])
+    is_instructor = (requester.get("role") == "instructor" and requester.id == course["instructor_id"])
 
     if not (is_admin or is_instructor):
         return jsonify({"Error": "You don't have permission on this resource"}), 403
 
-    # Step 4: Collect all students enrolled in the course
-    query = datastore_client.query(kind="users")
-    query.add_filter("role", "=", "student")
-    enrolled_students = []
+    # Step 4: Without limit/cursor, all students enrolled in the course from the enrollment index
+    cursor = request.args.get('cursor')
+    if 'limit' not in request.args and not cursor:
+        enrolled_students = repo.get_enrolled_student_ids(course_id)
+        return jsonify(enrolled_students), 200
+
+    # Step 5: Otherwise one page of student IDs, the class size from the course's counter,
+    # and a "next" link carrying an opaque cursor if the page was full
+    try:
+        limit = int(request.args.get('limit', MAX_PAGE_LIMIT))
+    except ValueError:
+        return jsonify({"Error": "Invalid query parameters"}), 400
+    if limit < 1:
+        return jsonify({"Error": "Invalid query parameters"}), 400
+    limit = min(limit, MAX_PAGE_LIMIT)
+    try:
+        student_ids, next_cursor = repo.list_enrolled_student_ids(course_id, limit, cursor=cursor)
+    except ValueError:
+        return jsonify({"Error": "Invalid query parameters"}), 400
 
-    for student in query.fetch():
-        if "courses" in student and course_id in student["courses"]:
-            enrolled_students.append(student.key.id)
+    response = {
+        "students": student_ids,
+        "count": repo.get_enrollment_count(course)
+    }
+    if len(student_ids) == limit and next_cursor:
+        query_string = urlencode({"limit": limit, "cursor": next_cursor})
+        response["next"] = f"{request.host_url.rstrip('/')}/courses/{course_id}/students?{query_string}"
+    return jsonify(response), 200
 
-    return jsonify(enrolled_students), 200
+
+# Route 13b - GET the number of students enrolled in a course, from the course's counter
+@app.route('/courses/<int:course_id>/students/count', methods=['GET'])
+def get_course_enrollment_count(course_id):
+    # Step 1: Verify JWT
+    sub, error_msg, status = verify_jwt_and_get_sub()
+    if error_msg:
+        return jsonify({"Error": "Unauthorized"}), 401
+
+    # Step 2: Retrieve course and requester user concurrently
+    course, requester = run_concurrently(
+        lambda: repo.get_course(course_id),
+        lambda: get_user_by_sub(sub)
+    )
+    if not course or not requester:
+        return jsonify({"Error": "You don't have permission on this resource"}), 403
+
+    # Step 3: Check the requester is admin or the course's instructor
+    is_admin = requester.get("role") == "admin"
+    is_instructor = (requester.get("role") == "instructor" and requester.id == course["instructor_id"])
+    if not (is_admin or is_instructor):
+        return jsonify({"Error": "You don't have permission on this resource"}), 403
+
+    return jsonify({"course_id": course_id, "enrollment_count": repo.get_enrollment_count(course)}), 200
+
+
+
+
+
+# Route 14 - GET in-process cache counters (admin only)
+@app.route('/admin/cache-stats', methods=['GET'])
+def get_cache_stats():
+    sub, error_msg, status = verify_jwt_and_get_sub()
+    if error_msg:
+        return jsonify({"Error": error_msg}), status
+
+    requester = get_user_by_sub(sub)
+    if not requester or requester["role"] != "admin":
+        return jsonify({"Error": "You don't have permission on this resource"}), 403
+
+    return jsonify({"avatar_cache": avatar_cache.stats()}), 200
+
+
+
+
+
+# Route 15 - GET Prometheus metrics
+@app.route('/metrics', methods=['GET'])
+def get_metrics():
+    if METRICS_TOKEN and request.headers.get('Authorization') != f"Bearer {METRICS_TOKEN}":
+        return jsonify({"Error": "Unauthorized"}), 401
+    return Response(metrics.registry.render(), mimetype="text/plain; version=0.0.4")
+
+
+# Helper function - create backend clients, open their connections and prime caches. Steps run
+# in parallel and independently, so one failing doesn't stop the rest. Returns each step's
+# duration in milliseconds (None if it failed)
+def run_warmup_steps():
+    steps = {
+        # Datastore client and channel, and the first page of courses in the course cache
+        "repository": lambda: list_courses_cached(repo.get_collection_version("courses"),
+                                                  DEFAULT_COURSE_PAGE_LIMIT, None, 0),
+        # Auth0 signing keys, so the first token check doesn't wait on DNS and TLS to Auth0
+        "jwks": lambda: get_jwks_client().get_signing_keys(),
+        # Cloud Storage client and a pooled connection; looking up a missing object is one round trip
+        "storage": lambda: get_photo_bucket().get_blob("_ah/warmup")
+    }
+
+    def timed(step):
+        def call():
+            started = time.perf_counter()
+            try:
+                step()
+            except Exception as e:
+                print("Exception:", e)
+                return None
+            return round((time.perf_counter() - started) * 1000, 1)
+        return call
+
+    return dict(zip(steps, run_concurrently(*(timed(step) for step in steps.values()))))
+
+
+_warmup_lock = threading.Lock()
+_warmup_result = None
+
+
+# Route 16 - App Engine warmup request (inbound_services: warmup in app.yaml), sent to a new
+# instance before it takes traffic. Warms up once per process; later calls only report it
+@app.route('/_ah/warmup', methods=['GET'])
+def warmup():
+    global _warmup_result
+    with _warmup_lock:
+        if _warmup_result is None:
+            _warmup_result = run_warmup_steps()
+    return jsonify({"warmup_ms": _warmup_result}), 200
 
 
 
@@ -622,51 +1574,38 @@ def get_course_enrollment(course_id):
 
 @app.route('/images', methods=['POST'])
 def store_image():
-    # Any files in the request will be available in request.files object
-    # Check if there is an entry in request.files with the key 'file'
-    if 'file' not in request.files:
-        return ('No file sent in request', 400)
-    # Set file_obj to the file sent in the request
-    file_obj = request.files['file']
+    # Get the shared handle on the bucket
+    bucket = get_photo_bucket()
+    # Stream the 'file' part into a blob named after the file as it arrives; oversized
+    # or non-PNG uploads are rejected without anything being stored
+    form, upload, error = receive_png_upload(bucket.blob)
+    if error:
+        return error
     # If the multipart form data has a part with name 'tag', set the
     # value of the variable 'tag' to the value of 'tag' in the request.
     # Note we are not doing anything with the variable 'tag' in this
     # example, however this illustrates how we can extract data from the
     # multipart form data in addition to the files.
-    if 'tag' in request.form:
-        tag = request.form['tag']
-    # Create a storage client
-    storage_client = storage.Client()
-    # Get a handle on the bucket
-    bucket = storage_client.get_bucket(PHOTO_BUCKET)
-    # Create a blob object for the bucket with the name of the file
-    blob = bucket.blob(file_obj.filename)
-    # Position the file_obj to its beginning
-    file_obj.seek(0)
-    # Upload the file into Cloud Storage
-    blob.upload_from_file(file_obj)
-    return ({'file_name': file_obj.filename},201)
+    if 'tag' in form:
+        tag = form['tag']
+    # Finish the upload into Cloud Storage
+    upload.commit()
+    return ({'file_name': upload.filename},201)
 
 @app.route('/images/<file_name>', methods=['GET'])
 def get_image(file_name):
-    storage_client = storage.Client()
-    bucket = storage_client.get_bucket(PHOTO_BUCKET)
-    # Create a blob with the given file name
-    blob = bucket.blob(file_name)
-    # Create a file object in memory using Python io package
-    file_obj = io.BytesIO()
-    # Download the file from Cloud Storage to the file_obj variable
-    blob.download_to_file(file_obj)
-    # Position the file_obj to its beginning
-    file_obj.seek(0)
-    # Send the object as a file in the response with the correct MIME type and file name
-    return send_file(file_obj, mimetype='image/x-png', download_name=file_name)
+    bucket = get_photo_bucket()
+    # Load the blob's metadata (size, etag, generation) for the given file name
+    blob = bucket.get_blob(file_name)
+    if blob is None:
+        return ('Not found', 404)
+    # Stream the object in chunks with the correct MIME type and file name
+    return send_blob(blob, 'image/x-png', file_name)
 
 
 @app.route('/images/<file_name>', methods=['DELETE'])
 def delete_image(file_name):
-    storage_client = storage.Client()
-    bucket = storage_client.get_bucket(PHOTO_BUCKET)
+    bucket = get_photo_bucket()
     blob = bucket.blob(file_name)
     # Delete the file from Cloud Storage
     blob.delete()
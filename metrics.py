@@ -0,0 +1,349 @@
+"""Low-overhead request and backend-call metrics in Prometheus text format.
+
+Per-route request latency and backend calls are recorded into fixed-bucket
+histograms. Backend calls are captured by thin proxies around the Datastore
+client and the Cloud Storage bucket (instrument_datastore / instrument_bucket),
+which time each RPC and count the entities it read or wrote. The route a call
+belongs to is carried in a ContextVar, so calls made from worker threads that
+run with a copy of the request's context are attributed correctly.
+"""
+import contextvars
+import threading
+import time
+from collections import Counter
+
+
+# Seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+# Backend calls made by one request
+CALL_COUNT_BUCKETS = (0, 1, 2, 3, 4, 5, 8, 10, 20, 50, 100, 500)
+
+current_route = contextvars.ContextVar("metrics_route", default="none")
+_current_calls = contextvars.ContextVar("metrics_calls", default=None)
+
+
+class Histogram:
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.total = 0.0
+
+    def observe(self, value):
+        index = 0
+        for bound in self.buckets:
+            if value <= bound:
+                break
+            index += 1
+        self.counts[index] += 1
+        self.total += value
+
+
+class Registry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._requests = Counter()
+        self._request_latency = {}
+        self._request_calls = {}
+        self._backend_latency = {}
+        self._backend_entities = Counter()
+        self._collectors = []
+
+    # -- recording ----------------------------------------------------------
+
+    def _observe(self, table, labels, buckets, value):
+        histogram = table.get(labels)
+        if histogram is None:
+            histogram = table[labels] = Histogram(buckets)
+        histogram.observe(value)
+
+    def observe_request(self, route, method, status, seconds, calls):
+        with self._lock:
+            self._requests[(route, method, str(status))] += 1
+            self._observe(self._request_latency, (route, method), LATENCY_BUCKETS, seconds)
+            for backend in ("datastore", "gcs"):
+                self._observe(self._request_calls, (route, backend), CALL_COUNT_BUCKETS, calls.get(backend, 0))
+
+    def observe_call(self, backend, op, seconds, entities):
+        route = current_route.get()
+        calls = _current_calls.get()
+        with self._lock:
+            self._observe(self._backend_latency, (route, backend, op), LATENCY_BUCKETS, seconds)
+            if entities:
+                self._backend_entities[(route, backend, op)] += entities
+            if calls is not None:
+                calls[backend] += 1
+
+    # A collector is a callable returning extra exposition lines (e.g. cache gauges)
+    def add_collector(self, collector):
+        self._collectors.append(collector)
+
+    # -- per-request scope ----------------------------------------------------
+
+    def start_request(self, route):
+        return (current_route.set(route), _current_calls.set(Counter()), time.perf_counter())
+
+    # Leaves the request's context and returns a callback that records the request. Run it once
+    # the response body has been sent: calls made while a body streams, from a context copied
+    # before this point, still land in the same counter and the latency covers the whole body
+    def finish_request(self, scope, route, method, status):
+        route_token, calls_token, started = scope
+        calls = _current_calls.get()
+        if calls is None:
+            calls = Counter()
+        current_route.reset(route_token)
+        _current_calls.reset(calls_token)
+        return lambda: self.observe_request(route, method, status, time.perf_counter() - started, calls)
+
+    # -- exposition -----------------------------------------------------------
+
+    def render(self):
+        with self._lock:
+            lines = []
+            lines += _render_counter("tarpaulin_requests_total", "Requests handled, by route, method and status.",
+                                     ("route", "method", "status"), self._requests)
+            lines += _render_histograms("tarpaulin_request_duration_seconds", "Request latency by route.",
+                                        ("route", "method"), self._request_latency)
+            lines += _render_histograms("tarpaulin_request_backend_calls", "Backend calls made per request.",
+                                        ("route", "backend"), self._request_calls)
+            lines += _render_histograms("tarpaulin_backend_call_duration_seconds",
+                                        "Latency of individual Datastore/GCS calls.",
+                                        ("route", "backend", "op"), self._backend_latency)
+            lines += _render_counter("tarpaulin_backend_entities_total",
+                                     "Entities (or objects) read or written by backend calls.",
+                                     ("route", "backend", "op"), self._backend_entities)
+        for collector in self._collectors:
+            lines += collector()
+        return "\n".join(lines) + "\n"
+
+
+def _labels(names, values, extra=""):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}"
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _render_counter(name, help_text, label_names, counter):
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} counter"]
+    for labels, value in sorted(counter.items()):
+        lines.append(f"{name}{_labels(label_names, labels)} {value}")
+    return lines
+
+
+def _render_histograms(name, help_text, label_names, histograms):
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+    for labels, histogram in sorted(histograms.items()):
+        cumulative = 0
+        for bound, count in zip(histogram.buckets, histogram.counts):
+            cumulative += count
+            le = 'le="%s"' % bound
+            lines.append(f"{name}_bucket{_labels(label_names, labels, le)} {cumulative}")
+        cumulative += histogram.counts[-1]
+        le = 'le="+Inf"'
+        lines.append(f"{name}_bucket{_labels(label_names, labels, le)} {cumulative}")
+        lines.append(f"{name}_sum{_labels(label_names, labels)} {histogram.total}")
+        lines.append(f"{name}_count{_labels(label_names, labels)} {cumulative}")
+    return lines
+
+
+def render_gauges(name, help_text, values, metric_type="gauge"):
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} {metric_type}"]
+    for labels, value in values:
+        label_text = _labels([k for k, _ in labels], [v for _, v in labels]) if labels else ""
+        lines.append(f"{name}{label_text} {value}")
+    return lines
+
+
+registry = Registry()
+
+
+# ---------------------------------------------------------------------------
+# Backend shims
+# ---------------------------------------------------------------------------
+
+class _Timed:
+    def __init__(self, backend, op):
+        self.backend = backend
+        self.op = op
+        self.entities = 0
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        registry.observe_call(self.backend, self.op, time.perf_counter() - self.started, self.entities)
+        return False
+
+
+class InstrumentedDatastoreClient:
+    def __init__(self, client):
+        self._client = client
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+    def get(self, key, *args, **kwargs):
+        with _Timed("datastore", "lookup") as call:
+            entity = self._client.get(key, *args, **kwargs)
+            call.entities = 1 if entity is not None else 0
+        return entity
+
+    def get_multi(self, keys, *args, **kwargs):
+        with _Timed("datastore", "lookup") as call:
+            entities = self._client.get_multi(keys, *args, **kwargs)
+            call.entities = len(entities)
+        return entities
+
+    def put(self, entity, *args, **kwargs):
+        self.put_multi([entity], *args, **kwargs)
+
+    # Writes inside a transaction are only buffered; the RPC is timed at commit
+    def put_multi(self, entities, *args, **kwargs):
+        if self._client.current_batch is not None:
+            return self._client.put_multi(entities, *args, **kwargs)
+        with _Timed("datastore", "put") as call:
+            call.entities = len(entities)
+            self._client.put_multi(entities, *args, **kwargs)
+
+    def delete(self, key, *args, **kwargs):
+        self.delete_multi([key], *args, **kwargs)
+
+    def delete_multi(self, keys, *args, **kwargs):
+        if self._client.current_batch is not None:
+            return self._client.delete_multi(keys, *args, **kwargs)
+        with _Timed("datastore", "delete") as call:
+            call.entities = len(keys)
+            self._client.delete_multi(keys, *args, **kwargs)
+
+    def query(self, *args, **kwargs):
+        return InstrumentedQuery(self._client.query(*args, **kwargs))
+
+    def transaction(self, *args, **kwargs):
+        return InstrumentedTransaction(self._client.transaction(*args, **kwargs))
+
+
+class InstrumentedQuery:
+    def __init__(self, query):
+        self._query = query
+
+    def __getattr__(self, name):
+        return getattr(self._query, name)
+
+    def __setattr__(self, name, value):
+        if name == "_query":
+            object.__setattr__(self, name, value)
+        else:
+            setattr(self._query, name, value)
+
+    def fetch(self, *args, **kwargs):
+        return InstrumentedIterator(self._query.fetch(*args, **kwargs))
+
+
+# Times the whole iteration (one or more RunQuery RPCs) and counts the entities it yielded
+class InstrumentedIterator:
+    def __init__(self, iterator):
+        self._iterator = iterator
+
+    def __getattr__(self, name):
+        return getattr(self._iterator, name)
+
+    def __iter__(self):
+        call = _Timed("datastore", "run_query")
+        elapsed = 0.0
+        iterator = iter(self._iterator)
+        try:
+            while True:
+                started = time.perf_counter()
+                try:
+                    entity = next(iterator)
+                except StopIteration:
+                    return
+                finally:
+                    elapsed += time.perf_counter() - started
+                call.entities += 1
+                yield entity
+        finally:
+            registry.observe_call(call.backend, call.op, elapsed, call.entities)
+
+
+class InstrumentedTransaction:
+    def __init__(self, transaction):
+        self._transaction = transaction
+
+    def __getattr__(self, name):
+        return getattr(self._transaction, name)
+
+    def __enter__(self):
+        with _Timed("datastore", "begin_transaction"):
+            self._transaction.__enter__()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        with _Timed("datastore", "commit" if exc_type is None else "rollback"):
+            return self._transaction.__exit__(exc_type, exc, tb)
+
+
+class InstrumentedBucket:
+    def __init__(self, bucket):
+        self._bucket = bucket
+
+    def __getattr__(self, name):
+        return getattr(self._bucket, name)
+
+    def blob(self, *args, **kwargs):
+        return InstrumentedBlob(self._bucket.blob(*args, **kwargs))
+
+    def get_blob(self, *args, **kwargs):
+        with _Timed("gcs", "get_metadata") as call:
+            blob = self._bucket.get_blob(*args, **kwargs)
+            call.entities = 1 if blob is not None else 0
+        return InstrumentedBlob(blob) if blob is not None else None
+
+    def list_blobs(self, *args, **kwargs):
+        with _Timed("gcs", "list") as call:
+            blobs = list(self._bucket.list_blobs(*args, **kwargs))
+            call.entities = len(blobs)
+        return blobs
+
+
+class InstrumentedBlob:
+    _TIMED = {
+        "exists": "get_metadata",
+        "reload": "get_metadata",
+        "download_as_bytes": "download",
+        "download_to_file": "download",
+        "upload_from_file": "upload",
+        "upload_from_string": "upload",
+        "delete": "delete",
+    }
+
+    def __init__(self, blob):
+        object.__setattr__(self, "_blob", blob)
+
+    def __getattr__(self, name):
+        attr = getattr(self._blob, name)
+        op = self._TIMED.get(name)
+        if op is None:
+            return attr
+
+        def timed(*args, **kwargs):
+            with _Timed("gcs", op) as call:
+                call.entities = 1
+                return attr(*args, **kwargs)
+        return timed
+
+    def __setattr__(self, name, value):
+        setattr(self._blob, name, value)
+
+
+def instrument_datastore(client):
+    return InstrumentedDatastoreClient(client)
+
+
+def instrument_bucket(bucket):
+    return InstrumentedBucket(bucket)
@@ -0,0 +1,114 @@
+"""One-off data migrations for the Tarpaulin API.
+
+Run against the configured Datastore project, e.g.:
+
+    python migrations.py backfill_enrollments backfill_enrollment_counts backfill_avatar_flags
+
+Every migration is idempotent and safe to re-run. They backfill Datastore
+entities, so they only apply with TARPAULIN_BACKEND=datastore.
+"""
+import sys
+
+from main import TARPAULIN_BACKEND, get_photo_bucket, repo
+
+
+BATCH_SIZE = 500
+
+
+# Build the course-side enrollment index from each student's `courses` list
+def backfill_enrollments():
+    datastore_client = repo.client
+    query = datastore_client.query(kind="users")
+    query.add_filter("role", "=", "student")
+
+    batch = []
+    written = 0
+    for student in query.fetch():
+        for course_id in student.get("courses", []):
+            batch.append(repo.enrollment_entity(course_id, student.key.id))
+            if len(batch) >= BATCH_SIZE:
+                datastore_client.put_multi(batch)
+                written += len(batch)
+                batch = []
+    if batch:
+        datastore_client.put_multi(batch)
+        written += len(batch)
+
+    print(f"backfill_enrollments: wrote {written} enrollment entries")
+    return written
+
+
+# Set each course's enrollment_count from its enrollment index (run after backfill_enrollments)
+def backfill_enrollment_counts():
+    datastore_client = repo.client
+    query = datastore_client.query(kind="courses")
+    query.keys_only()
+
+    updated = 0
+    for entity in query.fetch():
+        # Counted and written in one transaction so a concurrent enrollment change can't be lost
+        with datastore_client.transaction():
+            course = datastore_client.get(entity.key)
+            if course is None:
+                continue
+            count = len(repo.get_enrolled_student_ids(entity.key.id))
+            if course.get("enrollment_count") != count:
+                course["enrollment_count"] = count
+                datastore_client.put(course)
+                updated += 1
+
+    print(f"backfill_enrollment_counts: updated {updated} courses")
+    return updated
+
+
+# Set has_avatar/avatar_generation on users from the avatars stored in GCS,
+# and clear the flag on users whose avatar object no longer exists
+def backfill_avatar_flags():
+    datastore_client = repo.client
+    generations = {}
+    for blob in get_photo_bucket().list_blobs(prefix="avatars/"):
+        name = blob.name[len("avatars/"):]
+        if name.endswith(".png") and name[:-len(".png")].isdigit():
+            generations[int(name[:-len(".png")])] = blob.generation
+
+    keys = [datastore_client.key("users", user_id) for user_id in generations]
+    users = repo.get_multi_chunked(keys)
+
+    query = datastore_client.query(kind="users")
+    query.add_filter("has_avatar", "=", True)
+    flagged = [user for user in query.fetch() if user.key.id not in generations]
+
+    changed = []
+    for user in users:
+        generation = generations[user.key.id]
+        if not user.get("has_avatar") or user.get("avatar_generation") != generation:
+            user["has_avatar"] = True
+            user["avatar_generation"] = generation
+            changed.append(user)
+    for user in flagged:
+        user["has_avatar"] = False
+        user.pop("avatar_generation", None)
+        changed.append(user)
+
+    for start in range(0, len(changed), BATCH_SIZE):
+        datastore_client.put_multi(changed[start:start + BATCH_SIZE])
+
+    print(f"backfill_avatar_flags: updated {len(changed)} users")
+    return len(changed)
+
+
+MIGRATIONS = {
+    "backfill_enrollments": backfill_enrollments,
+    "backfill_enrollment_counts": backfill_enrollment_counts,
+    "backfill_avatar_flags": backfill_avatar_flags,
+}
+
+
+if __name__ == '__main__':
+    if TARPAULIN_BACKEND != "datastore":
+        sys.exit("Migrations only apply to the Datastore backend")
+    names = sys.argv[1:] or list(MIGRATIONS)
+    for name in names:
+        if name not in MIGRATIONS:
+            sys.exit(f"Unknown migration: {name} (choose from {', '.join(MIGRATIONS)})")
+        MIGRATIONS[name]()
@@ -0,0 +1,205 @@
+"""Opt-in sampling profiler for slow requests.
+
+While enabled, a background thread samples the Python stack of every thread that
+is serving a request, every PROFILE_INTERVAL_MS. When a request finishes, its
+samples are kept if it took at least PROFILE_SLOW_MS, or if it was picked by
+PROFILE_SAMPLE_RATE; otherwise they are dropped. Kept samples are aggregated per
+Flask endpoint and periodically written to PROFILE_DIR as collapsed stacks
+(`<endpoint>.<pid>.folded`, for flamegraph.pl / inferno) or speedscope JSON.
+
+Only the request's own thread is sampled, so time spent waiting on calls that run
+on the shared I/O pool shows up under `run_concurrently`. When neither threshold
+is configured, install() registers nothing and requests pay no cost at all.
+"""
+import atexit
+import json
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter, defaultdict
+
+from flask import g, request
+
+
+# Per-request cap so a stuck request can't grow without bound
+MAX_SAMPLES_PER_REQUEST = 20000
+
+
+class _ActiveRequest:
+    __slots__ = ("endpoint", "started", "sampled", "samples")
+
+    def __init__(self, endpoint, sampled):
+        self.endpoint = endpoint
+        self.started = time.perf_counter()
+        self.sampled = sampled
+        self.samples = []
+
+
+class SamplingProfiler:
+    def __init__(self, slow_ms=None, sample_rate=0.0, interval_ms=5.0, output_dir="profiles",
+                 output_format="folded", flush_seconds=60.0):
+        if output_format not in ("folded", "speedscope"):
+            raise ValueError(f"Unknown profile format: {output_format}")
+        self.slow_ms = slow_ms
+        self.sample_rate = sample_rate
+        self.interval = interval_ms / 1000
+        self.output_dir = output_dir
+        self.output_format = output_format
+        self.flush_seconds = flush_seconds
+        self._lock = threading.Lock()
+        self._active = {}
+        self._stacks = defaultdict(Counter)
+        self._requests = Counter()
+        self._dirty = False
+        self._thread = None
+        self._pid = None
+
+    @property
+    def enabled(self):
+        return bool(self.slow_ms) or self.sample_rate > 0
+
+    # -- request hooks --------------------------------------------------------
+
+    def start_request(self, endpoint):
+        sampled = self.sample_rate > 0 and random.random() < self.sample_rate
+        # With no slow threshold, requests that lost the coin toss are never kept
+        if not sampled and not self.slow_ms:
+            return None
+        self._ensure_sampler()
+        active = _ActiveRequest(endpoint, sampled)
+        with self._lock:
+            self._active[threading.get_ident()] = active
+        return active
+
+    def finish_request(self, active):
+        with self._lock:
+            self._active.pop(threading.get_ident(), None)
+        elapsed_ms = (time.perf_counter() - active.started) * 1000
+        if not active.samples or not (active.sampled or (self.slow_ms and elapsed_ms >= self.slow_ms)):
+            return
+        stacks = Counter(_frame_names(stack) for stack in active.samples)
+        with self._lock:
+            self._stacks[active.endpoint].update(stacks)
+            self._requests[active.endpoint] += 1
+            self._dirty = True
+
+    # -- sampling -------------------------------------------------------------
+
+    def _ensure_sampler(self):
+        # Threads don't survive a fork, so (re)start the sampler in each worker process
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name="request-profiler", daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        next_flush = time.monotonic() + self.flush_seconds
+        while True:
+            time.sleep(self.interval)
+            with self._lock:
+                active = list(self._active.items())
+            if active:
+                frames = sys._current_frames()
+                for thread_id, request_profile in active:
+                    frame = frames.get(thread_id)
+                    if frame is not None and len(request_profile.samples) < MAX_SAMPLES_PER_REQUEST:
+                        request_profile.samples.append(_code_stack(frame))
+                del frames
+            if time.monotonic() >= next_flush:
+                self.flush()
+                next_flush = time.monotonic() + self.flush_seconds
+
+    # -- output ---------------------------------------------------------------
+
+    # Writes the stacks aggregated so far (since process start) to output_dir
+    def flush(self):
+        with self._lock:
+            if not self._dirty:
+                return []
+            snapshot = {endpoint: Counter(stacks) for endpoint, stacks in self._stacks.items()}
+            requests = Counter(self._requests)
+            self._dirty = False
+
+        os.makedirs(self.output_dir, exist_ok=True)
+        written = []
+        for endpoint, stacks in snapshot.items():
+            extension = "folded" if self.output_format == "folded" else "speedscope.json"
+            path = os.path.join(self.output_dir, f"{endpoint}.{os.getpid()}.{extension}")
+            if self.output_format == "folded":
+                body = "".join(f"{';'.join(stack)} {count}\n" for stack, count in sorted(stacks.items()))
+            else:
+                body = json.dumps(_speedscope(endpoint, stacks, requests[endpoint], self.interval * 1000))
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, "w") as fh:
+                fh.write(body)
+            os.replace(tmp_path, path)
+            written.append(path)
+        return written
+
+
+def _code_stack(frame):
+    codes = []
+    while frame is not None:
+        codes.append((frame.f_code, frame.f_globals.get("__name__", "?")))
+        frame = frame.f_back
+    codes.reverse()
+    return tuple(codes)
+
+
+def _frame_names(stack):
+    return tuple(f"{module}:{getattr(code, 'co_qualname', code.co_name)}" for code, module in stack)
+
+
+def _speedscope(endpoint, stacks, request_count, interval_ms):
+    frame_index = {}
+    frames = []
+    samples = []
+    weights = []
+    for stack, count in stacks.items():
+        indexes = []
+        for name in stack:
+            if name not in frame_index:
+                frame_index[name] = len(frames)
+                frames.append({"name": name})
+            indexes.append(frame_index[name])
+        samples.append(indexes)
+        weights.append(count * interval_ms)
+    return {
+        "$schema": "https://www.speedscope.app/file-format-schema.json",
+        "name": f"{endpoint} ({request_count} requests)",
+        "shared": {"frames": frames},
+        "profiles": [{
+            "type": "sampled",
+            "name": endpoint,
+            "unit": "milliseconds",
+            "startValue": 0,
+            "endValue": sum(weights),
+            "samples": samples,
+            "weights": weights,
+        }],
+    }
+
+
+# Registers the profiler's request hooks on `app`; does nothing when the profiler is disabled
+def install(app, profiler):
+    if not profiler.enabled:
+        return None
+
+    @app.before_request
+    def start_request_profile():
+        g.request_profile = profiler.start_request(request.endpoint or "unmatched")
+
+    @app.teardown_request
+    def finish_request_profile(exc=None):
+        active = g.pop("request_profile", None)
+        if active is not None:
+            profiler.finish_request(active)
+
+    atexit.register(profiler.flush)
+    return profiler
@@ -0,0 +1,125 @@
+"""Per-caller token-bucket rate limiting.
+
+Every caller (a JWT sub, or a client IP for anonymous requests) gets a bucket of
+`burst` tokens per budget, refilled at `rate` tokens per second; each request
+takes one token, and a request that finds its bucket empty is refused with the
+number of seconds until a token is available. Routes listed as expensive draw
+from their own, smaller budget, so a caller looping on a full scan is stopped
+long before they could exhaust the backend quota for everybody.
+
+A bucket is kept as a single number, the time at which it would be full again
+(GCRA, the "generic cell rate algorithm"), so a check is one read and one write:
+
+- LocalBucketStore keeps buckets in process memory, so each instance enforces
+  its own budget.
+- RedisBucketStore keeps them in a shared Redis, so a caller's budget spans all
+  instances. The check runs as a server-side script, so it is atomic across
+  instances. Any client with redis-py's eval works, e.g. a local stand-in in
+  tests and benchmarks. Redis errors are logged and the request is let through.
+"""
+import math
+import threading
+import time
+from collections import namedtuple
+
+from caches import TTLCache
+
+
+# `rate` tokens per second, at most `burst` of them saved up
+Limit = namedtuple("Limit", ["rate", "burst"])
+
+
+# Takes a token from the bucket full again at `tat` (None for a new bucket) at time `now`, with
+# a token every `interval` and room for `burst`. Returns (new_tat, 0) if the token was taken,
+# or (None, wait) with the time until one is available
+def take_token(tat, now, interval, burst):
+    tat = now if tat is None else max(tat, now)
+    new_tat = tat + interval
+    wait = new_tat - burst * interval - now
+    if wait > 0:
+        return None, wait
+    return new_tat, 0
+
+
+class LocalBucketStore:
+    def __init__(self, maxsize=65536):
+        # Evicting an idle bucket only hands that caller a full bucket again
+        self._buckets = TTLCache(maxsize=maxsize)
+        self._lock = threading.Lock()
+
+    # Returns 0 when a token was taken, otherwise the seconds to wait
+    def take(self, key, limit):
+        interval = 1 / limit.rate
+        with self._lock:
+            now = time.monotonic()
+            tat, wait = take_token(self._buckets.get(key), now, interval, limit.burst)
+            if tat is not None:
+                # A bucket that has refilled is the same as no bucket
+                self._buckets.set(key, tat, ttl=tat - now)
+        return wait
+
+
+# KEYS[1] holds the bucket's full-again time in ms; ARGV is the ms per token and the burst.
+# Returns 0 when a token was taken, otherwise the ms to wait. Same algorithm as take_token,
+# on the Redis server's clock so instances with skewed clocks agree
+TAKE_TOKEN_SCRIPT = """
+local clock = redis.call('TIME')
+local now = tonumber(clock[1]) * 1000 + tonumber(clock[2]) / 1000
+local interval = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local tat = now
+local stored = redis.call('GET', KEYS[1])
+if stored then
+    tat = math.max(tonumber(stored), now)
+end
+local new_tat = tat + interval
+local wait = new_tat - burst * interval - now
+if wait > 0 then
+    return math.ceil(wait)
+end
+redis.call('SET', KEYS[1], string.format('%.3f', new_tat), 'PX', math.ceil(new_tat - now))
+return 0
+"""
+
+
+class RedisBucketStore:
+    def __init__(self, client, prefix="tarpaulin:ratelimit:"):
+        self.client = client
+        self.prefix = prefix
+
+    @classmethod
+    def from_url(cls, url, **kwargs):
+        # Optional dependency, only needed when a shared store is configured
+        import redis
+        return cls(redis.Redis.from_url(url), **kwargs)
+
+    def take(self, key, limit):
+        try:
+            wait_ms = self.client.eval(TAKE_TOKEN_SCRIPT, 1, self.prefix + key, 1000 / limit.rate, limit.burst)
+        except Exception as e:
+            print("Exception:", e)
+            return 0
+        return int(wait_ms) / 1000
+
+
+# Admission control over a bucket store: `default` applies to every endpoint, except that
+# `expensive_endpoints` share the separate `expensive` budget
+class RateLimiter:
+    def __init__(self, store, default, expensive=None, expensive_endpoints=()):
+        for limit in (default, expensive):
+            if limit is not None and (limit.rate <= 0 or limit.burst < 1):
+                raise ValueError(f"Invalid rate limit {limit}: rate must be > 0 and burst >= 1")
+        self.store = store
+        self.default = default
+        self.expensive = expensive or default
+        # Without a separate budget the expensive endpoints draw from the default one
+        self.expensive_endpoints = frozenset(expensive_endpoints) if expensive else frozenset()
+
+    # Returns 0 when the caller's request is admitted, otherwise whole seconds until it would be
+    def check(self, caller, endpoint):
+        if endpoint in self.expensive_endpoints:
+            budget, limit = "expensive", self.expensive
+        else:
+            budget, limit = "default", self.default
+        wait = self.store.take(f"{budget}:{caller}", limit)
+        return max(1, math.ceil(wait)) if wait > 0 else 0
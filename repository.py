@@ -0,0 +1,851 @@
+"""Persistence layer for users, courses and enrollments.
+
+Routes talk to a repository instead of a database client, so the same app can run
+on Cloud Datastore (DatastoreRepository, the production backend) or on an embedded
+SQLite database (SQLiteRepository, for single-node deployments, CI and
+benchmarks). Both return Record objects: plain dicts of the stored fields with the
+numeric ID on `.id`. main.py picks the backend from TARPAULIN_BACKEND.
+"""
+import base64
+import contextlib
+import itertools
+import json
+import random
+import sqlite3
+import threading
+import time
+
+from google.api_core.exceptions import BadRequest, Conflict
+from google.cloud import datastore
+
+
+# Datastore batch limits: keys per lookup and entities per commit
+MAX_LOOKUP_KEYS = 1000
+MAX_COMMIT_ENTITIES = 500
+
+# Courses created per commit, leaving room for the collection version counter
+MAX_COURSES_PER_COMMIT = MAX_COMMIT_ENTITIES - 1
+
+# Students enrolled or disenrolled per commit: each one writes its user entity and an enrollment
+# entry, plus one write for the course's enrollment count
+MAX_ENROLLMENT_CHANGES_PER_COMMIT = (MAX_COMMIT_ENTITIES - 1) // 2
+
+# Datastore aborts a transaction that loses to a concurrent one writing the same entity, e.g. the
+# collection version counter every course write bumps. It is retried up to TRANSACTION_ATTEMPTS
+# times in all, after a random wait of up to TRANSACTION_BACKOFF seconds, doubling each attempt.
+TRANSACTION_ATTEMPTS = 5
+TRANSACTION_BACKOFF = 0.05
+
+# Bound parameters per SQLite statement stay well under SQLITE_MAX_VARIABLE_NUMBER
+SQLITE_MAX_PARAMS = 500
+
+# Rows read per query while streaming every user out of SQLite
+SQLITE_SCAN_BATCH = 1000
+
+COURSE_FIELDS = ("subject", "number", "title", "term", "instructor_id")
+JOB_FIELDS = ("course_id", "requester_id", "status", "total", "processed", "failed", "error", "created", "updated")
+
+
+# Every course write bumps the course's own `version` and the collection version of
+# "courses", so callers can derive ETags for single courses and for course listings.
+
+class CourseNotFound(Exception):
+    pass
+
+
+# An enrollment change listed users that don't exist or aren't students
+class InvalidEnrollment(Exception):
+    pass
+
+
+# A stored user or course: its fields, plus the numeric ID on `.id`
+class Record(dict):
+    def __init__(self, id, fields=()):
+        super().__init__(fields)
+        self.id = id
+
+
+# Helper function - yield lists of at most `size` items from any iterable, without loading it all
+def chunked(items, size):
+    iterator = iter(items)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+# Stands in for the repository factory() builds, which is only built (once) on first use,
+# so that importing the app doesn't create database clients or open connections
+class LazyRepository:
+    def __init__(self, factory):
+        self._factory = factory
+        self._repository = None
+        self._lock = threading.Lock()
+
+    def resolve(self):
+        if self._repository is None:
+            with self._lock:
+                if self._repository is None:
+                    self._repository = self._factory()
+        return self._repository
+
+    def __getattr__(self, name):
+        return getattr(self.resolve(), name)
+
+
+class DatastoreRepository:
+    def __init__(self, client):
+        self.client = client
+
+    def _record(self, entity):
+        return Record(entity.key.id, entity) if entity is not None else None
+
+    def _entity(self, kind, record):
+        entity = datastore.Entity(key=self.client.key(kind, record.id))
+        entity.update(record)
+        return entity
+
+    # Runs work() in a transaction and returns its result, retrying it when the commit is
+    # aborted by contention. work() must read everything it changes, so a retry starts over.
+    def _transaction(self, work):
+        for attempt in range(TRANSACTION_ATTEMPTS):
+            try:
+                with self.client.transaction():
+                    return work()
+            except Conflict:
+                if attempt == TRANSACTION_ATTEMPTS - 1:
+                    raise
+                time.sleep(random.uniform(0, TRANSACTION_BACKOFF * 2 ** attempt))
+
+    # get_multi over any number of keys, in lookup-sized batches.
+    # Uses the current transaction when called inside one.
+    def get_multi_chunked(self, keys):
+        entities = []
+        for chunk in chunked(keys, MAX_LOOKUP_KEYS):
+            entities.extend(self.client.get_multi(chunk))
+        return entities
+
+    # Enrollment index entries live under the course key, so a roster read is a single ancestor query
+    def enrollment_key(self, course_id, student_id):
+        return self.client.key("courses", course_id, "enrollments", student_id)
+
+    def enrollment_entity(self, course_id, student_id):
+        enrollment = datastore.Entity(key=self.enrollment_key(course_id, student_id))
+        enrollment.update({
+            "course_id": course_id,
+            "student_id": student_id
+        })
+        return enrollment
+
+    # -- users ------------------------------------------------------------------
+
+    def get_user(self, user_id):
+        return self._record(self.client.get(self.client.key("users", user_id)))
+
+    def get_users(self, user_ids):
+        keys = [self.client.key("users", user_id) for user_id in user_ids]
+        return [self._record(entity) for entity in self.get_multi_chunked(keys)]
+
+    def find_user_by_sub(self, sub):
+        query = self.client.query(kind="users")
+        query.add_filter("sub", "=", sub)
+        results = list(query.fetch(limit=1))
+        return self._record(results[0]) if results else None
+
+    # Projection on (role, sub) reads only the composite index in index.yaml, never the
+    # full entities with their course lists
+    def _user_summaries(self, iterator):
+        for entity in iterator:
+            yield Record(entity.key.id, {"role": entity["role"], "sub": entity["sub"]})
+
+    # Every user's role and sub, fetched lazily page by page
+    def iter_users(self):
+        query = self.client.query(kind="users", projection=["role", "sub"])
+        return self._user_summaries(query.fetch())
+
+    # One page of users' role and sub; returns (users, next cursor or None).
+    # Raises ValueError for a malformed cursor.
+    def list_users(self, limit, cursor=None):
+        query = self.client.query(kind="users", projection=["role", "sub"])
+        try:
+            iterator = query.fetch(start_cursor=cursor, limit=limit)
+            users = list(self._user_summaries(iterator))
+        except BadRequest as e:
+            raise ValueError(str(e))
+
+        next_cursor = iterator.next_page_token
+        if isinstance(next_cursor, bytes):
+            next_cursor = next_cursor.decode("ascii")
+        return users, next_cursor
+
+    def create_user(self, fields):
+        user = datastore.Entity(key=self.client.key("users"))
+        user.update(fields)
+        self.client.put(user)
+        return self._record(user)
+
+    def save_user(self, user):
+        self.client.put(self._entity("users", user))
+
+    # Records the user's avatar generation and variant sizes, or clears the avatar when
+    # generation is None. Only the avatar fields of the freshly read entity change, so an
+    # enrollment committed meanwhile isn't overwritten. Returns the user (None if deleted).
+    def set_avatar(self, user_id, generation, variants=()):
+        def write():
+            user = self.client.get(self.client.key("users", user_id))
+            if user is None:
+                return None
+            if generation is None:
+                user["has_avatar"] = False
+                user.pop("avatar_generation", None)
+                user.pop("avatar_variants", None)
+            else:
+                user["has_avatar"] = True
+                user["avatar_generation"] = generation
+                user["avatar_variants"] = list(variants)
+            self.client.put(user)
+            return user
+
+        return self._record(self._transaction(write))
+
+    # Course IDs denormalized on the user entity
+    def get_user_course_ids(self, user):
+        return list(user.get("courses", []))
+
+    # -- courses ----------------------------------------------------------------
+
+    def get_course(self, course_id):
+        return self._record(self.client.get(self.client.key("courses", course_id)))
+
+    def create_course(self, fields):
+        return self.create_courses([fields])[0]
+
+    # Writes the courses in one commit; callers keep batches within MAX_COURSES_PER_COMMIT
+    def create_courses(self, fields_list):
+        courses = []
+        for fields in fields_list:
+            course = datastore.Entity(key=self.client.key("courses"))
+            course.update(fields)
+            course["version"] = 1
+            course["enrollment_count"] = 0
+            courses.append(course)
+
+        def write():
+            self.client.put_multi(courses)
+            self._bump_collection_version("courses")
+
+        self._transaction(write)
+        return [self._record(course) for course in courses]
+
+    # Saves the course's fields as its next version; raises CourseNotFound if it was deleted.
+    # The enrollment count is kept from the stored course, which enrollment changes update.
+    def save_course(self, course):
+        def write():
+            current = self.client.get(self.client.key("courses", course.id))
+            if not current:
+                raise CourseNotFound(course.id)
+            course["version"] = current.get("version", 0) + 1
+            course.pop("enrollment_count", None)
+            if "enrollment_count" in current:
+                course["enrollment_count"] = current["enrollment_count"]
+            self.client.put(self._entity("courses", course))
+            self._bump_collection_version("courses")
+
+        self._transaction(write)
+
+    # Collection versions are single counter entities; course writes are rare enough
+    # that the counter stays well under Datastore's per-entity write rate, and the
+    # transactions that bump it concurrently are retried by _transaction
+    def get_collection_version(self, name):
+        counter = self.client.get(self.client.key("versions", name))
+        return counter["value"] if counter else 0
+
+    def _bump_collection_version(self, name):
+        key = self.client.key("versions", name)
+        counter = self.client.get(key) or datastore.Entity(key=key)
+        counter["value"] = counter.get("value", 0) + 1
+        self.client.put(counter)
+
+    # One page of courses ordered by subject; returns (courses, next cursor or None).
+    # Raises ValueError for a malformed cursor.
+    def list_courses(self, limit, cursor=None, offset=0):
+        query = self.client.query(kind="courses")
+        query.order = ["subject"]
+        try:
+            if cursor:
+                iterator = query.fetch(start_cursor=cursor, limit=limit)
+            else:
+                iterator = query.fetch(offset=offset, limit=limit)
+            courses = [self._record(entity) for entity in iterator]
+        except BadRequest as e:
+            raise ValueError(str(e))
+
+        next_cursor = iterator.next_page_token
+        if isinstance(next_cursor, bytes):
+            next_cursor = next_cursor.decode("ascii")
+        return courses, next_cursor
+
+    # Deletes a course and its enrollment index, taking the course off its instructor and students.
+    # The course, its instructor's back-reference and the collection version go in one small
+    # transaction; once the course is gone no one can enroll in it, and the students are cleared
+    # in transactions of MAX_ENROLLMENT_CHANGES_PER_COMMIT. Calling this again for a course whose
+    # cleanup was interrupted finishes it, then raises CourseNotFound. Returns the changed users.
+    def delete_course(self, course_id):
+        course_key = self.client.key("courses", course_id)
+
+        def remove_course():
+            course = self.client.get(course_key)
+            if not course:
+                return None, []
+            changed_users = []
+            instructor = None
+            if course.get("instructor_id"):
+                instructor = self.client.get(self.client.key("users", course["instructor_id"]))
+            if instructor and course_id in instructor.get("courses", []):
+                instructor["courses"] = [cid for cid in instructor["courses"] if cid != course_id]
+                self.client.put(instructor)
+                changed_users.append(instructor)
+            self.client.delete(course_key)
+            self._bump_collection_version("courses")
+            return course, changed_users
+
+        course, changed_users = self._transaction(remove_course)
+        changed_users += self._clear_enrollments(course_id)
+        if course is None:
+            raise CourseNotFound(course_id)
+        return [self._record(user) for user in changed_users]
+
+    # Removes a deleted course's enrollment entries and the course from its students' lists,
+    # one commit-sized chunk of students per transaction. Returns the users that were changed.
+    def _clear_enrollments(self, course_id):
+        changed_users = []
+        student_ids = self.get_enrolled_student_ids(course_id)
+        for chunk in chunked(student_ids, MAX_ENROLLMENT_CHANGES_PER_COMMIT):
+            def clear(chunk=chunk):
+                changed = []
+                for user in self.get_multi_chunked([self.client.key("users", sid) for sid in chunk]):
+                    if course_id in user.get("courses", []):
+                        user["courses"] = [cid for cid in user["courses"] if cid != course_id]
+                        changed.append(user)
+                self.client.put_multi(changed)
+                self.client.delete_multi([self.enrollment_key(course_id, sid) for sid in chunk])
+                return changed
+
+            changed_users += self._transaction(clear)
+        return changed_users
+
+    # -- enrollments ------------------------------------------------------------
+
+    # IDs of the students enrolled in a course, O(enrolled)
+    def get_enrolled_student_ids(self, course_id):
+        query = self.client.query(kind="enrollments", ancestor=self.client.key("courses", course_id))
+        query.keys_only()
+        return [entity.key.id for entity in query.fetch()]
+
+    # One page of enrolled student IDs in ID order; returns (IDs, next cursor or None).
+    # Raises ValueError for a malformed cursor.
+    def list_enrolled_student_ids(self, course_id, limit, cursor=None):
+        query = self.client.query(kind="enrollments", ancestor=self.client.key("courses", course_id))
+        query.keys_only()
+        try:
+            iterator = query.fetch(start_cursor=cursor, limit=limit)
+            student_ids = [entity.key.id for entity in iterator]
+        except BadRequest as e:
+            raise ValueError(str(e))
+
+        next_cursor = iterator.next_page_token
+        if isinstance(next_cursor, bytes):
+            next_cursor = next_cursor.decode("ascii")
+        return student_ids, next_cursor
+
+    # Class size from the counter on the course; courses written before the counter existed
+    # (and not yet backfilled) are counted from the enrollment index instead
+    def get_enrollment_count(self, course):
+        if "enrollment_count" in course:
+            return course["enrollment_count"]
+        return len(self.get_enrolled_student_ids(course.id))
+
+    # Enrolls add_ids and disenrolls remove_ids after checking that every ID is a student.
+    # Returns the users whose course list changed. Each ID costs up to two writes, so a change of
+    # up to MAX_ENROLLMENT_CHANGES_PER_COMMIT students is one transaction. A larger one is checked
+    # as a whole first and then applied in transactions of that many; if it still fails midway
+    # (e.g. a student deleted meanwhile), repeating it completes it, as every step is idempotent.
+    def update_enrollment(self, course_id, add_ids, remove_ids):
+        changes = [(sid, "add") for sid in set(add_ids)] + [(sid, "remove") for sid in set(remove_ids)]
+        if len(changes) > MAX_ENROLLMENT_CHANGES_PER_COMMIT:
+            self._check_enrollment(course_id, [sid for sid, _ in changes])
+
+        changed_students = []
+        for chunk in chunked(changes, MAX_ENROLLMENT_CHANGES_PER_COMMIT):
+            changed_students += self._apply_enrollment(course_id,
+                                                       [sid for sid, action in chunk if action == "add"],
+                                                       [sid for sid, action in chunk if action == "remove"])
+        return changed_students
+
+    # Raises CourseNotFound or InvalidEnrollment unless the course exists and every ID is a student
+    def _check_enrollment(self, course_id, student_ids):
+        keys = [self.client.key("courses", course_id)] + [self.client.key("users", sid) for sid in student_ids]
+        found = self.get_multi_chunked(keys)
+        if not any(entity.key.kind == "courses" for entity in found):
+            raise CourseNotFound(course_id)
+        students = [entity for entity in found if entity.key.kind == "users"]
+        if len(students) != len(student_ids) or any(student.get("role") != "student" for student in students):
+            raise InvalidEnrollment(course_id)
+
+    # One transaction of update_enrollment, re-checking its own IDs
+    def _apply_enrollment(self, course_id, add_ids, remove_ids):
+        all_ids = set(add_ids) | set(remove_ids)
+
+        def write():
+            keys = ([self.client.key("courses", course_id)]
+                    + [self.client.key("users", uid) for uid in all_ids]
+                    + [self.enrollment_key(course_id, uid) for uid in all_ids])
+            found = self.get_multi_chunked(keys)
+            course = next((entity for entity in found if entity.key.kind == "courses"), None)
+            if course is None:
+                raise CourseNotFound(course_id)
+
+            students = {e.key.id: e for e in found if e.key.kind == "users"}
+            enrolled = {e.key.id for e in found if e.key.kind == "enrollments"}
+            if len(students) != len(all_ids) or any(student.get("role") != "student" for student in students.values()):
+                raise InvalidEnrollment(course_id)
+
+            # The count only moves by the enrollments actually created or removed. A course
+            # written before the counter existed starts from its enrollment index.
+            delta = len(set(add_ids) - enrolled) - len(set(remove_ids) & enrolled)
+            if "enrollment_count" not in course:
+                course["enrollment_count"] = len(self.get_enrolled_student_ids(course_id)) + delta
+                self.client.put(course)
+            elif delta:
+                course["enrollment_count"] += delta
+                self.client.put(course)
+
+            changed_students = []
+            enrollments = []
+            for sid in add_ids:
+                student = students[sid]
+                courses = student.get("courses", [])
+                if course_id not in courses:
+                    student["courses"] = courses + [course_id]
+                    changed_students.append(student)
+                enrollments.append(self.enrollment_entity(course_id, sid))
+
+            for sid in remove_ids:
+                student = students[sid]
+                if course_id in student.get("courses", []):
+                    student["courses"] = [cid for cid in student["courses"] if cid != course_id]
+                    changed_students.append(student)
+
+            # Writes are buffered by the transaction and committed together on exit
+            self.client.put_multi(changed_students + enrollments)
+            self.client.delete_multi([self.enrollment_key(course_id, sid) for sid in remove_ids])
+            return changed_students
+
+        return [self._record(student) for student in self._transaction(write)]
+
+    # -- enrollment jobs ----------------------------------------------------------
+
+    # Per-ID failures are free-form, so they're kept out of the indexes
+    def _job_entity(self, key, fields):
+        entity = datastore.Entity(key=key, exclude_from_indexes=("failures",))
+        entity.update(fields)
+        return entity
+
+    def _job(self, entity):
+        job = self._record(entity)
+        if job is not None:
+            job["failures"] = [dict(failure) for failure in job.get("failures", [])]
+            job.setdefault("failed", len(job["failures"]))
+        return job
+
+    def create_job(self, fields):
+        job = self._job_entity(self.client.key("enrollment_jobs"), fields)
+        self.client.put(job)
+        return self._job(job)
+
+    def get_job(self, job_id):
+        return self._job(self.client.get(self.client.key("enrollment_jobs", job_id)))
+
+    def save_job(self, job):
+        self.client.put(self._job_entity(self.client.key("enrollment_jobs", job.id), job))
+
+
+SQLITE_SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    id INTEGER PRIMARY KEY,
+    sub TEXT,
+    role TEXT NOT NULL,
+    has_avatar INTEGER NOT NULL DEFAULT 0,
+    avatar_generation INTEGER,
+    avatar_variants TEXT
+);
+CREATE INDEX IF NOT EXISTS users_sub ON users (sub);
+CREATE INDEX IF NOT EXISTS users_role ON users (role);
+
+CREATE TABLE IF NOT EXISTS courses (
+    id INTEGER PRIMARY KEY,
+    subject TEXT NOT NULL,
+    number INTEGER NOT NULL,
+    title TEXT NOT NULL,
+    term TEXT NOT NULL,
+    instructor_id INTEGER NOT NULL,
+    version INTEGER NOT NULL DEFAULT 1,
+    enrollment_count INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS courses_subject ON courses (subject, id);
+CREATE INDEX IF NOT EXISTS courses_instructor ON courses (instructor_id);
+
+CREATE TABLE IF NOT EXISTS enrollments (
+    course_id INTEGER NOT NULL,
+    student_id INTEGER NOT NULL,
+    PRIMARY KEY (course_id, student_id)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS enrollments_student ON enrollments (student_id, course_id);
+
+CREATE TABLE IF NOT EXISTS enrollment_jobs (
+    id INTEGER PRIMARY KEY,
+    course_id INTEGER NOT NULL,
+    requester_id INTEGER,
+    status TEXT NOT NULL,
+    total INTEGER NOT NULL,
+    processed INTEGER NOT NULL DEFAULT 0,
+    failed INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    failures TEXT,
+    created TEXT,
+    updated TEXT
+);
+
+CREATE TABLE IF NOT EXISTS versions (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+"""
+
+# Columns added after a table was first created: (table, column, definition, backfill statement)
+SQLITE_ADDED_COLUMNS = [
+    ("courses", "version", "INTEGER NOT NULL DEFAULT 1", None),
+    ("users", "avatar_variants", "TEXT", None),
+    ("courses", "enrollment_count", "INTEGER NOT NULL DEFAULT 0",
+     "UPDATE courses SET enrollment_count = (SELECT COUNT(*) FROM enrollments WHERE course_id = courses.id)"),
+    ("enrollment_jobs", "failed", "INTEGER NOT NULL DEFAULT 0",
+     "UPDATE enrollment_jobs SET failed = json_array_length(failures) WHERE failures IS NOT NULL"),
+]
+
+
+# Embedded SQLite backend. A file database gets one connection per thread (WAL mode, so
+# readers never block on the writer); ":memory:" shares a single connection behind a lock.
+class SQLiteRepository:
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._shared = None
+        self._lock = contextlib.nullcontext()
+        if path == ":memory:":
+            self._shared = self._open()
+            self._lock = threading.RLock()
+        with self._lock:
+            conn = self._connection()
+            conn.executescript(SQLITE_SCHEMA)
+            for table, column, definition, backfill in SQLITE_ADDED_COLUMNS:
+                columns = {row["name"] for row in conn.execute(f"PRAGMA table_info({table})")}
+                if column not in columns:
+                    conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+                    if backfill:
+                        conn.execute(backfill)
+
+    def _open(self):
+        conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False, timeout=30)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def _connection(self):
+        if self._shared is not None:
+            return self._shared
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = self._open()
+        return conn
+
+    @contextlib.contextmanager
+    def _read(self):
+        with self._lock:
+            yield self._connection()
+
+    # A write transaction that takes the database write lock up front
+    @contextlib.contextmanager
+    def _write(self):
+        with self._lock:
+            conn = self._connection()
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+
+    def _user(self, row):
+        if row is None:
+            return None
+        user = Record(row["id"], {"role": row["role"], "sub": row["sub"], "has_avatar": bool(row["has_avatar"])})
+        if row["avatar_generation"] is not None:
+            user["avatar_generation"] = row["avatar_generation"]
+        if row["avatar_variants"]:
+            user["avatar_variants"] = json.loads(row["avatar_variants"])
+        return user
+
+    def _course(self, row):
+        if row is None:
+            return None
+        course = Record(row["id"], {field: row[field] for field in COURSE_FIELDS})
+        course["version"] = row["version"]
+        course["enrollment_count"] = row["enrollment_count"]
+        return course
+
+    def _job(self, row):
+        if row is None:
+            return None
+        job = Record(row["id"], {field: row[field] for field in JOB_FIELDS})
+        job["failures"] = json.loads(row["failures"]) if row["failures"] else []
+        return job
+
+    # -- users ------------------------------------------------------------------
+
+    def get_user(self, user_id):
+        with self._read() as conn:
+            return self._user(conn.execute("SELECT * FROM users WHERE id = ?", (user_id,)).fetchone())
+
+    def get_users(self, user_ids):
+        users = []
+        with self._read() as conn:
+            for chunk in chunked(user_ids, SQLITE_MAX_PARAMS):
+                marks = ",".join("?" * len(chunk))
+                rows = conn.execute(f"SELECT * FROM users WHERE id IN ({marks})", chunk).fetchall()
+                users.extend(self._user(row) for row in rows)
+        return users
+
+    def find_user_by_sub(self, sub):
+        with self._read() as conn:
+            return self._user(conn.execute("SELECT * FROM users WHERE sub = ? LIMIT 1", (sub,)).fetchone())
+
+    def _user_summaries(self, after_id, limit):
+        with self._read() as conn:
+            rows = conn.execute("SELECT id, role, sub FROM users WHERE id > ? ORDER BY id LIMIT ?",
+                                (after_id, limit)).fetchall()
+        return [Record(row["id"], {"role": row["role"], "sub": row["sub"]}) for row in rows]
+
+    # Every user's role and sub, read in keyset batches so no lock or cursor stays open
+    def iter_users(self):
+        after_id = 0
+        while True:
+            users = self._user_summaries(after_id, SQLITE_SCAN_BATCH)
+            yield from users
+            if len(users) < SQLITE_SCAN_BATCH:
+                return
+            after_id = users[-1].id
+
+    def list_users(self, limit, cursor=None):
+        after_id = _decode_cursor(cursor, int)[0] if cursor else 0
+        users = self._user_summaries(after_id, limit)
+        return users, _encode_cursor(users[-1].id) if len(users) == limit else None
+
+    def create_user(self, fields):
+        with self._write() as conn:
+            cursor = conn.execute(
+                "INSERT INTO users (sub, role, has_avatar, avatar_generation, avatar_variants) "
+                "VALUES (?, ?, ?, ?, ?)",
+                (fields.get("sub"), fields["role"], int(bool(fields.get("has_avatar"))),
+                 fields.get("avatar_generation"), _json_list(fields.get("avatar_variants"))))
+            return Record(cursor.lastrowid, fields)
+
+    def save_user(self, user):
+        with self._write() as conn:
+            conn.execute(
+                "UPDATE users SET sub = ?, role = ?, has_avatar = ?, avatar_generation = ?, avatar_variants = ? "
+                "WHERE id = ?",
+                (user.get("sub"), user["role"], int(bool(user.get("has_avatar"))),
+                 user.get("avatar_generation"), _json_list(user.get("avatar_variants")), user.id))
+
+    def set_avatar(self, user_id, generation, variants=()):
+        with self._write() as conn:
+            return self._user(conn.execute(
+                "UPDATE users SET has_avatar = ?, avatar_generation = ?, avatar_variants = ? WHERE id = ? RETURNING *",
+                (int(generation is not None), generation,
+                 _json_list(variants if generation is not None else ()), user_id)).fetchone())
+
+    # Students' courses come from their enrollments, instructors' from the courses they teach
+    def get_user_course_ids(self, user):
+        with self._read() as conn:
+            if user.get("role") == "student":
+                rows = conn.execute("SELECT course_id FROM enrollments WHERE student_id = ?", (user.id,))
+            else:
+                rows = conn.execute("SELECT id FROM courses WHERE instructor_id = ?", (user.id,))
+            return [row[0] for row in rows]
+
+    # -- courses ----------------------------------------------------------------
+
+    def get_course(self, course_id):
+        with self._read() as conn:
+            return self._course(conn.execute("SELECT * FROM courses WHERE id = ?", (course_id,)).fetchone())
+
+    def create_course(self, fields):
+        return self.create_courses([fields])[0]
+
+    def create_courses(self, fields_list):
+        courses = []
+        with self._write() as conn:
+            for fields in fields_list:
+                cursor = conn.execute(
+                    "INSERT INTO courses (subject, number, title, term, instructor_id) VALUES (?, ?, ?, ?, ?)",
+                    tuple(fields[field] for field in COURSE_FIELDS))
+                courses.append(Record(cursor.lastrowid, {**fields, "version": 1, "enrollment_count": 0}))
+            self._bump_collection_version(conn, "courses")
+        return courses
+
+    def save_course(self, course):
+        with self._write() as conn:
+            row = conn.execute(
+                "UPDATE courses SET subject = ?, number = ?, title = ?, term = ?, instructor_id = ?, "
+                "version = version + 1 WHERE id = ? RETURNING version, enrollment_count",
+                tuple(course[field] for field in COURSE_FIELDS) + (course.id,)).fetchone()
+            if row is None:
+                raise CourseNotFound(course.id)
+            course["version"] = row["version"]
+            course["enrollment_count"] = row["enrollment_count"]
+            self._bump_collection_version(conn, "courses")
+
+    def get_collection_version(self, name):
+        with self._read() as conn:
+            row = conn.execute("SELECT value FROM versions WHERE name = ?", (name,)).fetchone()
+            return row["value"] if row else 0
+
+    def _bump_collection_version(self, conn, name):
+        conn.execute("INSERT INTO versions (name, value) VALUES (?, 1) "
+                     "ON CONFLICT (name) DO UPDATE SET value = value + 1", (name,))
+
+    # Keyset pagination over (subject, id); the cursor is the last row's position
+    def list_courses(self, limit, cursor=None, offset=0):
+        with self._read() as conn:
+            if cursor:
+                subject, last_id = _decode_cursor(cursor, str, int)
+                rows = conn.execute(
+                    "SELECT * FROM courses WHERE (subject, id) > (?, ?) ORDER BY subject, id LIMIT ?",
+                    (subject, last_id, limit)).fetchall()
+            else:
+                rows = conn.execute("SELECT * FROM courses ORDER BY subject, id LIMIT ? OFFSET ?",
+                                    (limit, offset)).fetchall()
+        courses = [self._course(row) for row in rows]
+        next_cursor = _encode_cursor(rows[-1]["subject"], rows[-1]["id"]) if len(rows) == limit else None
+        return courses, next_cursor
+
+    def delete_course(self, course_id):
+        with self._write() as conn:
+            if conn.execute("SELECT 1 FROM courses WHERE id = ?", (course_id,)).fetchone() is None:
+                raise CourseNotFound(course_id)
+            rows = conn.execute(
+                "SELECT users.* FROM enrollments JOIN users ON users.id = enrollments.student_id "
+                "WHERE enrollments.course_id = ?", (course_id,)).fetchall()
+            conn.execute("DELETE FROM enrollments WHERE course_id = ?", (course_id,))
+            conn.execute("DELETE FROM courses WHERE id = ?", (course_id,))
+            self._bump_collection_version(conn, "courses")
+        return [self._user(row) for row in rows]
+
+    # -- enrollments ------------------------------------------------------------
+
+    def get_enrolled_student_ids(self, course_id):
+        with self._read() as conn:
+            rows = conn.execute("SELECT student_id FROM enrollments WHERE course_id = ?", (course_id,))
+            return [row[0] for row in rows]
+
+    # Keyset pagination over the enrollments primary key; the cursor is the last student ID
+    def list_enrolled_student_ids(self, course_id, limit, cursor=None):
+        after_id = _decode_cursor(cursor, int)[0] if cursor else 0
+        with self._read() as conn:
+            rows = conn.execute(
+                "SELECT student_id FROM enrollments WHERE course_id = ? AND student_id > ? "
+                "ORDER BY student_id LIMIT ?", (course_id, after_id, limit))
+            student_ids = [row[0] for row in rows]
+        return student_ids, _encode_cursor(student_ids[-1]) if len(student_ids) == limit else None
+
+    def get_enrollment_count(self, course):
+        return course["enrollment_count"]
+
+    def update_enrollment(self, course_id, add_ids, remove_ids):
+        all_ids = list(set(add_ids) | set(remove_ids))
+        with self._write() as conn:
+            if conn.execute("SELECT 1 FROM courses WHERE id = ?", (course_id,)).fetchone() is None:
+                raise CourseNotFound(course_id)
+
+            students = {}
+            for chunk in chunked(all_ids, SQLITE_MAX_PARAMS):
+                marks = ",".join("?" * len(chunk))
+                rows = conn.execute(f"SELECT * FROM users WHERE id IN ({marks}) AND role = 'student'", chunk)
+                students.update((row["id"], row) for row in rows)
+            if len(students) != len(all_ids):
+                raise InvalidEnrollment(course_id)
+
+            changed = []
+            delta = 0
+            for sid in add_ids:
+                cursor = conn.execute("INSERT OR IGNORE INTO enrollments (course_id, student_id) VALUES (?, ?)",
+                                      (course_id, sid))
+                if cursor.rowcount:
+                    changed.append(students[sid])
+                    delta += 1
+            for sid in remove_ids:
+                cursor = conn.execute("DELETE FROM enrollments WHERE course_id = ? AND student_id = ?",
+                                      (course_id, sid))
+                if cursor.rowcount:
+                    changed.append(students[sid])
+                    delta -= 1
+            if delta:
+                conn.execute("UPDATE courses SET enrollment_count = enrollment_count + ? WHERE id = ?",
+                             (delta, course_id))
+        return [self._user(row) for row in changed]
+
+    # -- enrollment jobs ----------------------------------------------------------
+
+    def create_job(self, fields):
+        with self._write() as conn:
+            cursor = conn.execute(
+                f"INSERT INTO enrollment_jobs ({', '.join(JOB_FIELDS)}, failures) "
+                f"VALUES ({', '.join('?' * (len(JOB_FIELDS) + 1))})",
+                tuple(fields.get(field) for field in JOB_FIELDS) + (_json_list(fields.get("failures")),))
+            return Record(cursor.lastrowid, fields)
+
+    def get_job(self, job_id):
+        with self._read() as conn:
+            return self._job(conn.execute("SELECT * FROM enrollment_jobs WHERE id = ?", (job_id,)).fetchone())
+
+    def save_job(self, job):
+        with self._write() as conn:
+            conn.execute(
+                f"UPDATE enrollment_jobs SET {', '.join(f'{field} = ?' for field in JOB_FIELDS)}, failures = ? "
+                "WHERE id = ?",
+                tuple(job.get(field) for field in JOB_FIELDS) + (_json_list(job.get("failures")), job.id))
+
+
+# List-valued fields are stored as JSON text (NULL when empty)
+def _json_list(values):
+    return json.dumps(list(values)) if values else None
+
+
+# Keyset cursors are the sort key of the last row returned, as urlsafe base64 JSON
+def _encode_cursor(*position):
+    return base64.urlsafe_b64encode(json.dumps(position).encode()).decode("ascii")
+
+
+# Raises ValueError for anything that isn't a cursor of values with the given types
+def _decode_cursor(cursor, *types):
+    try:
+        position = json.loads(base64.urlsafe_b64decode(cursor.encode("ascii")))
+    except Exception:
+        raise ValueError("Invalid cursor")
+    if (not isinstance(position, list) or len(position) != len(types)
+            or not all(isinstance(value, kind) for value, kind in zip(position, types))):
+        raise ValueError("Invalid cursor")
+    return position
@@ -0,0 +1,237 @@
+"""Streaming, size-limited PNG uploads.
+
+receive_png() parses a multipart/form-data request body as it arrives instead of
+letting Flask spool it to memory or disk first. The file part is checked against
+the PNG signature on its first bytes and counted against a byte limit chunk by
+chunk; only then is it passed on to its sink, normally a BlobUpload that streams
+it to Cloud Storage as a resumable upload, and optionally to an incremental image
+decoder. A request whose Content-Length is already over the limit is rejected
+before any of the body is read.
+
+A rejected upload is aborted instead of committed: the resumable upload session
+is never finalized, so no object (or partial object) appears in the bucket.
+"""
+import contextvars
+import threading
+from collections import deque
+
+from PIL import ImageFile
+from werkzeug.exceptions import RequestEntityTooLarge
+from werkzeug.formparser import FormDataParser
+
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+
+# Room for multipart boundaries, part headers and small text fields on top of the file itself
+FORM_OVERHEAD_BYTES = 64 * 1024
+MAX_FORM_PARTS = 16
+# Parser buffer and text field limit (Flask's MAX_FORM_MEMORY_SIZE default)
+MAX_FORM_MEMORY_BYTES = 500_000
+
+# Decoded avatars are bounded too, so a small, highly compressed PNG can't claim gigabytes
+MAX_IMAGE_PIXELS = 4096 * 4096
+
+
+class UploadTooLarge(Exception):
+    pass
+
+
+class InvalidUpload(Exception):
+    pass
+
+
+class UploadAborted(Exception):
+    pass
+
+
+# Bounded in-memory byte pipe from the request thread (write) to an uploader thread (read)
+class _Pipe:
+    def __init__(self, max_buffered):
+        self._max_buffered = max_buffered
+        self._cond = threading.Condition()
+        self._chunks = deque()
+        self._buffered = 0
+        self._position = 0
+        self._eof = False
+        self._error = None
+
+    def write(self, data):
+        with self._cond:
+            while self._buffered >= self._max_buffered and self._error is None:
+                self._cond.wait()
+            if self._error is not None:
+                raise self._error
+            self._chunks.append(bytes(data))
+            self._buffered += len(data)
+            self._cond.notify_all()
+
+    def close(self):
+        with self._cond:
+            self._eof = True
+            self._cond.notify_all()
+
+    def fail(self, error):
+        with self._cond:
+            if self._error is None:
+                self._error = error
+            self._cond.notify_all()
+
+    def read(self, size=-1):
+        with self._cond:
+            while self._error is None and not self._eof and (size < 0 or self._buffered < size):
+                self._cond.wait()
+            if self._error is not None:
+                raise self._error
+            wanted = self._buffered if size < 0 else min(size, self._buffered)
+            parts = []
+            while wanted:
+                chunk = self._chunks.popleft()
+                if len(chunk) > wanted:
+                    self._chunks.appendleft(chunk[wanted:])
+                    chunk = chunk[:wanted]
+                parts.append(chunk)
+                wanted -= len(chunk)
+            data = b"".join(parts)
+            self._buffered -= len(data)
+            self._position += len(data)
+            self._cond.notify_all()
+            return data
+
+    def tell(self):
+        return self._position
+
+
+# Streams written bytes into `blob` with a resumable upload of chunk_size chunks, run on its
+# own thread so the request thread can keep reading the body. The object only exists once
+# commit() returns; abort() fails the upload before its last chunk is sent.
+class BlobUpload:
+    def __init__(self, blob, chunk_size, content_type="image/png"):
+        self.blob = blob
+        self._pipe = _Pipe(2 * chunk_size)
+        self._error = None
+        blob.chunk_size = chunk_size
+        context = contextvars.copy_context()
+        self._thread = threading.Thread(target=context.run, args=(self._run, content_type),
+                                        name="blob-upload", daemon=True)
+        self._thread.start()
+
+    def _run(self, content_type):
+        try:
+            self.blob.upload_from_file(self._pipe, content_type=content_type)
+        except BaseException as exc:
+            self._error = exc
+            # Unblocks a writer waiting for buffer space
+            self._pipe.fail(exc)
+
+    def write(self, data):
+        self._pipe.write(data)
+
+    def commit(self):
+        self._pipe.close()
+        self._thread.join()
+        if self._error is not None:
+            raise self._error
+        return self.blob
+
+    def abort(self):
+        self._pipe.fail(UploadAborted())
+        self._thread.join()
+
+
+# The file part of a request: written to by the multipart parser as chunks arrive
+class PNGUpload:
+    def __init__(self, filename, max_bytes, open_sink=None, decode=False):
+        self.filename = filename
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.image = None
+        self._open_sink = open_sink
+        self._sink = None
+        self._head = b""
+        self._decoder = ImageFile.Parser() if decode else None
+
+    def write(self, data):
+        self.size += len(data)
+        if self.size > self.max_bytes:
+            raise UploadTooLarge()
+        # Hold back the first few bytes until the whole signature can be checked
+        if self._head is not None:
+            self._head += data
+            if not self._head.startswith(PNG_SIGNATURE[:len(self._head)]):
+                raise InvalidUpload()
+            if len(self._head) < len(PNG_SIGNATURE):
+                return len(data)
+            data, self._head = self._head, None
+            if self._open_sink is not None:
+                self._sink = self._open_sink(self.filename)
+        if self._sink is not None:
+            self._sink.write(data)
+        if self._decoder is not None:
+            self._feed(data)
+        return len(data)
+
+    def _feed(self, data):
+        try:
+            self._decoder.feed(data)
+        except Exception:
+            raise InvalidUpload()
+        image = self._decoder.image
+        if image is not None and image.width * image.height > MAX_IMAGE_PIXELS:
+            raise InvalidUpload()
+
+    # The parser rewinds each file part once it is complete; nothing is kept to rewind
+    def seek(self, offset, whence=0):
+        return 0
+
+    # Checks the complete part; decodes it when decoding was requested
+    def finish(self):
+        if self._head is not None:
+            raise InvalidUpload()
+        if self._decoder is not None:
+            try:
+                self.image = self._decoder.close()
+            except Exception:
+                raise InvalidUpload()
+            if self.image.format != "PNG":
+                raise InvalidUpload()
+        return self
+
+    # Stores the upload; returns the sink's result (the blob, for a BlobUpload)
+    def commit(self):
+        return self._sink.commit() if self._sink is not None else None
+
+    def abort(self):
+        if self._sink is not None:
+            self._sink.abort()
+
+
+# Parses the multipart body of the WSGI request in `environ`, which must carry exactly one file
+# part, named `field`. The part is streamed through a PNGUpload into open_sink(filename) (or
+# discarded when open_sink is None). Returns (form, upload), ready to commit(); raises
+# UploadTooLarge or InvalidUpload with anything already sent to the sink aborted.
+def receive_png(environ, max_bytes, open_sink=None, decode=False, field="file"):
+    received = []
+
+    def stream_factory(total_content_length, content_type, filename, content_length=None):
+        if received:
+            raise InvalidUpload()
+        received.append(PNGUpload(filename, max_bytes, open_sink, decode))
+        return received[0]
+
+    parser = FormDataParser(stream_factory, max_form_memory_size=MAX_FORM_MEMORY_BYTES,
+                            max_content_length=max_bytes + FORM_OVERHEAD_BYTES,
+                            silent=False, max_form_parts=MAX_FORM_PARTS)
+    try:
+        try:
+            _, form, files = parser.parse_from_environ(environ)
+        except RequestEntityTooLarge:
+            raise UploadTooLarge()
+        except ValueError:
+            raise InvalidUpload()
+        if not received or files.get(field) is None or files[field].stream is not received[0]:
+            raise InvalidUpload()
+        return form, received[0].finish()
+    except BaseException:
+        if received:
+            received[0].abort()
+        raise